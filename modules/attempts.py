@@ -0,0 +1,149 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# vim: set ts=4 sw=4 et:
+#
+# This module implements the database of the upgrades that failed in
+# previous runs. An upgrade is identified by the recipe, the version it is
+# upgraded from and to, and the content of the recipe directory and of every
+# file bitbake read to parse the recipe, so a failure is only known as long
+# as the same upgrade would be attempted again.
+#
+
+import os
+import json
+import hashlib
+import tempfile
+import logging as log
+from logging import debug as D
+from logging import warning as W
+
+from errors import *
+from utils.bitbake import get_build_dir
+
+ATTEMPTS_VERSION = 1
+
+# recipe variables the key of an upgrade is made of
+ATTEMPT_ENV_VARIABLES = ('FILE', 'BBINCLUDED', 'TOPDIR')
+
+def _content_hash(path):
+    h = hashlib.sha256()
+    try:
+        with open(path, 'rb') as f:
+            for chunk in iter(lambda: f.read(65536), b''):
+                h.update(chunk)
+    except OSError:
+        return "-"
+    return h.hexdigest()
+
+def attempt_key(pn, pv, npv, nsrcrev, env):
+    """ Returns the key of upgrading pn from pv to npv/nsrcrev, env holds
+        the ATTEMPT_ENV_VARIABLES of the recipe. Only contents are hashed,
+        the same upgrade has the same key in a worker build directory or
+        worktree. The build directory configuration isn't part of it. """
+    h = hashlib.sha256()
+    h.update(("%s %s %s %s\n" % (pn, pv, npv, nsrcrev)).encode('utf-8'))
+
+    recipe_dir = os.path.dirname(env['FILE'])
+    for root, dirs, files in os.walk(recipe_dir):
+        dirs.sort()
+        for f in sorted(files):
+            path = os.path.join(root, f)
+            h.update(("%s %s\n" % (os.path.relpath(path, recipe_dir),
+                _content_hash(path))).encode('utf-8'))
+
+    build_dirs = [d.rstrip("/") + "/" for d in
+            (env.get('TOPDIR'), get_build_dir()) if d]
+    hashes = set()
+    for path in env.get('BBINCLUDED', '').split():
+        if not any(path.startswith(d) for d in build_dirs):
+            hashes.add(_content_hash(path))
+    for content in sorted(hashes):
+        h.update(("%s\n" % content).encode('utf-8'))
+
+    return h.hexdigest()
+
+class Attempts(object):
+    def __init__(self, db_file):
+        self.db_file = db_file
+        self.failures = self._load()
+
+        super(Attempts, self).__init__()
+
+    def _load(self):
+        if not os.path.exists(self.db_file):
+            return dict()
+
+        try:
+            with open(self.db_file) as f:
+                db = json.load(f)
+        except (OSError, ValueError) as e:
+            W(" Ignoring attempts database %s: %s" % (self.db_file, e))
+            return dict()
+
+        if db.get('version') != ATTEMPTS_VERSION:
+            return dict()
+        return db['failures']
+
+    def _save(self):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.db_file),
+                suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({'version': ATTEMPTS_VERSION,
+                       'failures': self.failures}, f)
+        os.replace(tmp, self.db_file)
+
+    def candidate(self, pn, pv, npv, nsrcrev):
+        """ Whether upgrading pn like this failed before, the key has to
+            match too for the failure to be known. """
+        entry = self.failures.get(pn)
+        return entry is not None and entry['pv'] == pv and \
+                entry['npv'] == npv and entry['nsrcrev'] == nsrcrev
+
+    def known_failure(self, pn, key):
+        """ Returns the failure of the same upgrade, or None """
+        entry = self.failures.get(pn)
+        if entry is None or entry['key'] != key:
+            return None
+        return entry
+
+    def record(self, pkg_ctx, key):
+        """ Remembers a failed upgrade, forgets pkg_ctx if it didn't fail """
+        error = pkg_ctx.error
+        # fetch failures, timeouts and other transient errors are often
+        # temporary, try those again
+        if error is None or error.transient or isinstance(error,
+                (UpgradeNotNeededError, UnsupportedProtocolError, FetchError,
+                 CommandTimeoutError)):
+            if self.failures.pop(pkg_ctx.pn, None) is not None:
+                self._save()
+            return
+
+        D(" %s: Recording the failure for the next runs" % pkg_ctx.pn)
+        self.failures[pkg_ctx.pn] = {
+            'key': key, 'pv': pkg_ctx.pv, 'npv': pkg_ctx.npv,
+            'nsrcrev': pkg_ctx.nsrcrev,
+            'error': {'type': type(error).__name__,
+                      'message': error.message,
+                      'log_file': error.log_file},
+            'workdir': pkg_ctx.workdir,
+            'license_diff_fn': pkg_ctx.license_diff_fn}
+        self._save()
+
+    def restore(self, pkg_ctx, entry):
+        """ Fills pkg_ctx with a known failure, its logs are copied to the
+            work directory of pkg_ctx. """
+        import shutil
+
+        pkg_ctx.workdir = os.path.join(pkg_ctx.base_dir, pkg_ctx.pn)
+        if entry['workdir'] is not None and os.path.isdir(entry['workdir']):
+            shutil.copytree(entry['workdir'], pkg_ctx.workdir)
+        else:
+            os.mkdir(pkg_ctx.workdir)
+
+        log_file = entry['error']['log_file']
+        if log_file is not None:
+            log_file = os.path.join(pkg_ctx.workdir, os.path.basename(log_file))
+            if not os.path.exists(log_file):
+                log_file = None
+        pkg_ctx.error = restore_error(entry['error']['type'],
+                entry['error']['message'], log_file)
+        pkg_ctx.license_diff_fn = entry['license_diff_fn']
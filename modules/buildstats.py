@@ -0,0 +1,162 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# vim: set ts=4 sw=4 et:
+#
+# This module reads what the buildstats class (in USER_CLASSES or INHERIT)
+# wrote for the builds of an upgraded recipe: wall-clock time, CPU time and
+# IO of every task, to tell the cost of the recipe itself from the cost of
+# the other recipes its upgrade made bitbake rebuild.
+#
+
+import os
+import re
+import glob
+import logging as log
+from logging import debug as D
+
+from utils.bitbake import MULTICONFIG_PREFIX, pf_recipe_name
+
+# other recipes listed in a cost breakdown
+BUILDSTATS_TOP = 10
+
+ELAPSED = re.compile("Elapsed time: ([0-9.]+)")
+
+CPU_KEYS = ('rusage ru_utime', 'rusage ru_stime',
+            'Child rusage ru_utime', 'Child rusage ru_stime')
+
+def buildstats_roots(tmpdir, build_dir):
+    """ Returns the buildstats directories of tmpdir, of the TMPDIRs next to
+        it (another C library may have its own) and of AUH multiconfigs. """
+    tmpdirs = set([tmpdir])
+    tmpdirs.update(glob.glob(os.path.join(os.path.dirname(tmpdir), "tmp*")))
+    tmpdirs.update(glob.glob(os.path.join(build_dir,
+        "tmp-" + MULTICONFIG_PREFIX + "*")))
+    return sorted(os.path.join(t, "buildstats") for t in tmpdirs)
+
+def _new_stats():
+    return {'elapsed': 0.0, 'cpu': 0.0, 'read_bytes': 0, 'write_bytes': 0}
+
+def _add(total, stats):
+    for key in total:
+        total[key] += stats[key]
+
+def read_task(task_file):
+    stats = _new_stats()
+    started = ended = None
+    with open(task_file, errors='replace') as f:
+        for line in f:
+            key, _, value = line.strip().partition(": ")
+            m = ELAPSED.search(line)
+            try:
+                if m:
+                    stats['elapsed'] = float(m.group(1))
+                elif key in CPU_KEYS:
+                    stats['cpu'] += float(value)
+                elif key == 'IO read_bytes':
+                    stats['read_bytes'] = int(value)
+                elif key == 'IO write_bytes':
+                    stats['write_bytes'] = int(value)
+                elif key == 'Started':
+                    started = float(value)
+                elif key == 'Ended':
+                    ended = float(value)
+            except ValueError:
+                continue
+
+    if not stats['elapsed'] and started is not None and ended is not None:
+        stats['elapsed'] = ended - started
+    return stats
+
+class BuildStats(object):
+    def __init__(self, roots):
+        self.roots = roots
+        self.seen = self._builds()
+
+        super(BuildStats, self).__init__()
+
+    def _builds(self):
+        builds = set()
+        for root in self.roots:
+            if os.path.isdir(root):
+                builds.update(os.path.join(root, b) for b in os.listdir(root))
+        return builds
+
+    def collect(self):
+        """ Returns the tasks of the builds that happened since the last
+            call, as {TMPDIR: [(PF, task, stats)]}. """
+        builds = self._builds()
+        new = builds - self.seen
+        self.seen = builds
+
+        tasks = dict()
+        for build in sorted(new):
+            tmpdir = os.path.dirname(os.path.dirname(build))
+            if not os.path.isdir(build):
+                continue
+            for pf in os.listdir(build):
+                pf_dir = os.path.join(build, pf)
+                if not os.path.isdir(pf_dir):
+                    continue
+                for task in os.listdir(pf_dir):
+                    try:
+                        stats = read_task(os.path.join(pf_dir, task))
+                    except OSError as e:
+                        D(" Can't read buildstats of %s %s: %s" % (pf, task, e))
+                        continue
+                    tasks.setdefault(tmpdir, []).append((pf, task, stats))
+        return tasks
+
+def recipe_cost(pn, tasks):
+    """ Splits tasks into the ones of pn (and its native/nativesdk
+        variants), per task, and the ones of other recipes, per recipe. """
+    own_names = (pn, pn + "-native", "nativesdk-" + pn)
+    cost = {'own': dict(), 'others': dict()}
+    for pf, task, stats in tasks:
+        name = pf_recipe_name(pf)
+        if name in own_names:
+            _add(cost['own'].setdefault(task, _new_stats()), stats)
+        else:
+            _add(cost['others'].setdefault(name, _new_stats()), stats)
+    return cost
+
+def cost_totals(cost):
+    """ Returns the total stats of the recipe and of the other recipes """
+    own = _new_stats()
+    others = _new_stats()
+    for stats in cost['own'].values():
+        _add(own, stats)
+    for stats in cost['others'].values():
+        _add(others, stats)
+    return own, others
+
+def total_cost(costs):
+    """ Returns the total stats of the recipe, of the other recipes and
+        how many other recipes were built, over several builds. """
+    own = _new_stats()
+    others = _new_stats()
+    names = set()
+    for cost in costs:
+        build_own, build_others = cost_totals(cost)
+        _add(own, build_own)
+        _add(others, build_others)
+        names.update(cost['others'])
+    return own, others, len(names)
+
+def _format_stats(name, stats):
+    return "    %-32s %9.1fs wall %9.1fs cpu %8.1fMB read %8.1fMB written\n" % \
+            (name, stats['elapsed'], stats['cpu'],
+             stats['read_bytes'] / 1048576.0, stats['write_bytes'] / 1048576.0)
+
+def format_cost(pn, cost):
+    own, others = cost_totals(cost)
+    msg = "Tasks of %s:\n" % pn
+    for task, stats in sorted(cost['own'].items(),
+            key=lambda t: -t[1]['elapsed']):
+        msg += _format_stats(task, stats)
+    msg += _format_stats("total", own)
+
+    msg += "\nOther recipes built (%d):\n" % len(cost['others'])
+    top = sorted(cost['others'].items(), key=lambda t: -t[1]['elapsed'])
+    for name, stats in top[:BUILDSTATS_TOP]:
+        msg += _format_stats(name, stats)
+    msg += _format_stats("total", others)
+    return msg
@@ -0,0 +1,69 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# vim: set ts=4 sw=4 et:
+#
+# This module implements the context kept for every recipe during an
+# upgrade run. Contexts live until the end of the run so they only hold
+# what the steps, statistics and emails read; bitbake environments and
+# build logs stay out of them.
+#
+
+class RecipeContext(object):
+    __slots__ = (
+        'pn',               # recipe name
+        'pv',               # current version
+        'npv',              # version to upgrade to
+        'maintainer',
+        'nsrcrev',          # revision to upgrade to or N/A
+        'base_dir',         # where the recipe work directory is created
+        'workdir',          # recipe work directory, logs and patches
+        'recipe_dir',       # directory of the recipe in the layer
+        'error',            # Error instance if the upgrade failed
+        'commit_msg',
+        'patch_file',
+        'license_diff_fn',
+        'buildhistory',
+        'worker',           # worker build directory used to upgrade it
+        'fetch_error',      # FetchError if the pre-fetch failed
+        'attempt_key',      # identifies this upgrade across runs
+        'timings',          # (step, machine, started, seconds) not stored yet
+        'build_costs',      # machine -> buildstats cost of the builds
+        'arch_scope',       # what PACKAGE_ARCH depends on: all, tune, machine
+        'covered_machines', # machine -> machine whose build is the same
+        'machine_order',    # machines to build, most failing first
+        'known_fingerprints', # fingerprint -> machines, from previous runs
+        'failures',         # (machine, task, fingerprint) of failed builds
+        'retries',          # attempts again after temporary failures
+        'retry_at',         # when the next attempt may start
+    )
+
+    def __init__(self, pn, pv, npv, maintainer, nsrcrev, base_dir):
+        self.pn = pn
+        self.pv = pv
+        self.npv = npv
+        self.maintainer = maintainer
+        self.nsrcrev = nsrcrev
+        self.base_dir = base_dir
+        self.retries = 0
+        self.retry_at = None
+
+        self.reset()
+
+    def reset(self):
+        """ Forgets what an attempt to upgrade the recipe left """
+        self.workdir = None
+        self.recipe_dir = None
+        self.error = None
+        self.commit_msg = None
+        self.patch_file = None
+        self.license_diff_fn = None
+        self.buildhistory = None
+        self.worker = None
+        self.fetch_error = None
+        self.attempt_key = None
+        self.timings = []
+        self.build_costs = dict()
+        self.arch_scope = 'machine'
+        self.covered_machines = dict()
+        self.machine_order = None
+        self.known_fingerprints = dict()
+        self.failures = []
@@ -28,10 +28,38 @@ class Error(Exception):
         self.message = message
         self.stdout = stdout
         self.stderr = stderr
+        self.log_file = None
+        # the command failed for a reason that may go away (network...)
+        self.transient = False
 
     def __str__(self):
         return "Failed(other errors)"
 
+    def save_log(self, log_file):
+        """ Moves the command output to log_file so it isn't kept in
+            memory until the end of the run """
+        if not self.stdout and not self.stderr:
+            return
+
+        with open(log_file, "w") as f:
+            if self.stdout:
+                f.write(self.stdout)
+            f.write("\n")
+            if self.stderr:
+                f.write(self.stderr)
+
+        self.log_file = log_file
+        self.stdout = None
+        self.stderr = None
+
+    def get_output(self):
+        if self.log_file is not None:
+            with open(self.log_file) as f:
+                return f.read()
+
+        return "%s\n%s" % (self.stdout if self.stdout else "",
+                self.stderr if self.stderr else "")
+
 class MaintainerError(Error):
     """ Class for group error that can be sent to Maintainer's """
 
@@ -103,11 +131,30 @@ class EmptyEnvError(Error):
     def __str__(self):
         return "Failed(get_env)"
 
+class CommandTimeoutError(Error):
+    def __init__(self, command, timeout, stdout=None, stderr=None):
+        super(CommandTimeoutError, self).__init__("'%s' timed out after %d"
+                " minutes" % (command, timeout // 60), stdout, stderr)
+
+    def __str__(self):
+        return "Failed(timeout)"
+
 class IntegrationError(Error):
     def __init__(self, stdout, pkg_ctx):
         super(IntegrationError, self).__init__("Failed to build %s in testimage branch"
-                % pkg_ctx['PN'], stdout)
+                % pkg_ctx.pn, stdout)
         self.pkg_ctx = pkg_ctx
 
         def __str__(self):
             return "Failed(integrate)"
+
+def restore_error(name, message, log_file=None):
+    """ Recreates an error saved by name, its output is in log_file """
+    cls = globals().get(name)
+    if not isinstance(cls, type) or not issubclass(cls, Error):
+        cls = Error
+
+    e = cls.__new__(cls)
+    Error.__init__(e, message)
+    e.log_file = log_file
+    return e
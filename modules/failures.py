@@ -0,0 +1,239 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# vim: set ts=4 sw=4 et:
+#
+# This module implements the classification of build failures and the
+# database of the failures of previous runs, per recipe and machine. The
+# bitbake output is read once, line by line, to find the failed task (and
+# the matching error), a short excerpt of the log and a fingerprint. A
+# fingerprint is made of the failed task and of the error lines, without
+# what changes from one machine or one build to another, so the same failure
+# on several machines has the same fingerprint. The history tells which
+# machines fail the most, they are built first.
+#
+
+import re
+import time
+import hashlib
+import sqlite3
+import threading
+import logging as log
+from logging import debug as D
+from collections import deque
+
+from errors import *
+from utils.bitbake import multiconfig_name, split_machine, recipe_name, \
+        TRANSIENT_ERROR
+
+# runs the failures are counted over
+FAILURE_HISTORY = 10
+
+# error lines a fingerprint is made of
+FINGERPRINT_LINES = 20
+
+# lines of the task log kept in the excerpt of a failure, error lines
+# are kept up to EXCERPT_ERROR_LINES
+EXCERPT_LOG_LINES = 50
+EXCERPT_ERROR_LINES = 50
+
+# tasks that do the same for every machine
+MACHINE_INDEPENDENT_TASKS = ('do_fetch', 'do_unpack', 'do_patch',
+                             'do_populate_lic')
+
+# error raised for a failed task, by task name prefix
+TASK_ERRORS = (
+    ('do_fetch', FetchError),
+    ('do_unpack', PatchError),
+    ('do_patch', PatchError),
+    ('do_configure', ConfigureError),
+    ('do_populate_lic', LicenseError),
+    ('do_package', PackageError),
+)
+
+OUTPUT_LINE = re.compile(
+    # not real errors
+    r"(?P<ignored>.* went backwards which would break package feeds "
+    r"|.*not in COMPATIBLE|.*Nothing PROVIDES)"
+    r"|(?P<task>ERROR: Task \((?:mc:[^:]*:)?(?P<fn>.*):(?P<name>do_[^)]*)\) failed)"
+    r"|(?P<license>ERROR:.*(?:LIC_FILES_CHKSUM|md5 data is not matching))"
+    r"|(?P<error>ERROR:)"
+    r"|(?P<log>\| )")
+
+ERROR_LINE = re.compile(r"\berror\b", re.IGNORECASE)
+PATH = re.compile(r"(/[^\s:'\"()]+)+/")
+HASH = re.compile(r"\b[0-9a-f]{7,}\b")
+NUMBER = re.compile(r"\d+")
+
+FAILURES_SCHEMA = """CREATE TABLE IF NOT EXISTS failures (
+    run TEXT NOT NULL,
+    pn TEXT NOT NULL,
+    machine TEXT NOT NULL,
+    task TEXT,
+    fingerprint TEXT NOT NULL,
+    started REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS failures_pn ON failures (pn, run);
+"""
+
+def _machine_names(machine):
+    """ Matches the names of machine as whole words, longest first so
+        that a multiconfig or libc variant isn't left half replaced """
+    names = set([machine, multiconfig_name(machine)])
+    names.update(n for n in split_machine(machine) if n)
+    names = sorted(names, key=lambda n: (-len(n), n))
+    return re.compile(r"(?<![\w-])(?:%s)(?![\w-])" %
+            "|".join(re.escape(n) for n in names))
+
+def _normalize(line, machine_names):
+    line = machine_names.sub("<machine>", line)
+    line = PATH.sub("", line)
+    line = HASH.sub("<hash>", line)
+    return NUMBER.sub("N", line).strip()
+
+class Failure(object):
+    """ What went wrong in a build: the failed task, the log excerpt and
+        the fingerprint """
+    def __init__(self, task, license, transient, excerpt, fingerprint):
+        self.task = task
+        self.license = license
+        self.transient = transient
+        self.excerpt = excerpt
+        self.fingerprint = fingerprint
+
+        super(Failure, self).__init__()
+
+    def error(self):
+        """ Returns the error matching the failed task, with the excerpt
+            as its output """
+        cls = CompilationError
+        if self.license:
+            cls = LicenseError
+        elif self.task is not None:
+            for prefix, task_cls in TASK_ERRORS:
+                if self.task.startswith(prefix):
+                    cls = task_cls
+                    break
+
+        e = cls()
+        e.stdout = self.excerpt
+        # only fetching may work when tried again
+        e.transient = self.transient and cls is FetchError
+        return e
+
+def classify(lines, pn, machine):
+    """ Reads the output of a failed build of pn for machine, lines is any
+        iterable of lines. Returns a Failure, or None if the output tells it
+        isn't a real failure. """
+    task = None
+    license = False
+    transient = False
+    errors = []
+    fingerprint_lines = []
+    log_tail = deque(maxlen=EXCERPT_LOG_LINES)
+    task_log = None
+    machine_names = _machine_names(machine)
+    for line in lines:
+        m = OUTPUT_LINE.match(line)
+        if m is None:
+            continue
+        line = line.rstrip("\n")
+        if not transient and TRANSIENT_ERROR.search(line):
+            transient = True
+
+        if m.group('ignored'):
+            return None
+        if m.group('log'):
+            log_tail.append(line)
+            if ERROR_LINE.search(line) and \
+                    len(fingerprint_lines) < FINGERPRINT_LINES:
+                fingerprint_lines.append(_normalize(line, machine_names))
+            continue
+
+        if m.group('task'):
+            # the task of pn itself, rather than a dependency, if it failed
+            if task is None or (recipe_name(m.group('fn')) == pn and
+                    recipe_name(task[0]) != pn):
+                task = (m.group('fn'), m.group('name'))
+            # the log bitbake prints comes before the task failure
+            if task_log is None:
+                task_log = list(log_tail)
+        elif m.group('license'):
+            license = True
+
+        if len(errors) < EXCERPT_ERROR_LINES:
+            errors.append(line)
+        if len(fingerprint_lines) < FINGERPRINT_LINES:
+            fingerprint_lines.append(_normalize(line, machine_names))
+
+    if task_log is None:
+        task_log = list(log_tail)
+    task_name = task[1] if task is not None else None
+
+    h = hashlib.sha1()
+    h.update(("%s\n" % task_name).encode('utf-8'))
+    for line in fingerprint_lines:
+        h.update(("%s\n" % line).encode('utf-8'))
+
+    excerpt = "\n".join(task_log + [""] + errors) + "\n"
+    return Failure(task_name, license, transient, excerpt,
+            h.hexdigest()[:16])
+
+class FailureHistory(object):
+    def __init__(self, db_file, run):
+        self.run = run
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self.db.executescript(FAILURES_SCHEMA)
+
+        super(FailureHistory, self).__init__()
+
+    def record(self, pkg_ctx):
+        """ Stores the build failures of pkg_ctx, (machine, task,
+            fingerprint) """
+        started = time.time()
+        with self.lock, self.db:
+            self.db.executemany("INSERT INTO failures VALUES (?, ?, ?, ?, ?, ?)",
+                    [(self.run, pkg_ctx.pn, machine, task, fp, started)
+                     for machine, task, fp in pkg_ctx.failures])
+
+    def forget(self, pn):
+        """ Drops the failures of pn in this run, it is upgraded again """
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM failures WHERE run = ? AND pn = ?",
+                    (self.run, pn))
+
+    def _counts(self, pn=None):
+        query = "SELECT machine, COUNT(*) FROM failures WHERE run IN" \
+                " (SELECT run FROM failures WHERE run != ? GROUP BY run" \
+                " ORDER BY MAX(started) DESC LIMIT ?)"
+        params = [self.run, FAILURE_HISTORY]
+        if pn is not None:
+            query += " AND pn = ?"
+            params.append(pn)
+        with self.lock:
+            rows = self.db.execute(query + " GROUP BY machine",
+                    params).fetchall()
+        return dict(rows)
+
+    def machine_order(self, pn, machines):
+        """ Orders machines by how often pn failed on them, then by how
+            often anything failed on them, otherwise keeping their order. """
+        recipe_counts = self._counts(pn)
+        counts = self._counts()
+        position = dict((m, i) for i, m in enumerate(machines))
+        return sorted(machines, key=lambda m: (-recipe_counts.get(m, 0),
+                -counts.get(m, 0), position[m]))
+
+    def fingerprints(self, pn):
+        """ Returns the machines each known failure of pn happened on """
+        with self.lock:
+            rows = self.db.execute("SELECT fingerprint, machine FROM failures"
+                    " WHERE pn = ? AND run != ?", (pn, self.run)).fetchall()
+
+        fingerprints = dict()
+        for fp, machine in rows:
+            fingerprints.setdefault(fp, set()).add(machine)
+        return fingerprints
+
+    def close(self):
+        with self.lock:
+            self.db.close()
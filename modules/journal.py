@@ -0,0 +1,118 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# vim: set ts=4 sw=4 et:
+#
+# This module implements the journal of an upgrade run. Every event (the
+# recipes to upgrade, each step done, each commit, each recipe finished) is
+# appended to a file in the work directory as soon as it happens, so that a
+# run that died can be resumed from it.
+#
+
+import os
+import json
+import threading
+import logging as log
+from logging import debug as D
+
+from errors import *
+
+JOURNAL_FILE = "journal.jsonl"
+
+class Journal(object):
+    def __init__(self, work_dir):
+        self.journal_file = os.path.join(work_dir, JOURNAL_FILE)
+        self.lock = threading.Lock()
+
+        self.recipes = None
+        self.started = dict()
+        self.recipe_dirs = dict()
+        self.commits = dict()
+        self.done = dict()
+        self.cut = False
+        if os.path.exists(self.journal_file):
+            self._load()
+
+        super(Journal, self).__init__()
+
+    def _load(self):
+        line = ""
+        with open(self.journal_file) as f:
+            for line in f:
+                try:
+                    event = json.loads(line)
+                except ValueError:
+                    # the last line may be cut if the run was killed
+                    D(" Ignoring journal line: %s" % line)
+                    continue
+
+                if event['event'] == 'run':
+                    self.recipes = [tuple(r) for r in event['recipes']]
+                elif event['event'] == 'start':
+                    self.started[event['pn']] = []
+                elif event['event'] == 'step':
+                    self.started.setdefault(event['pn'], []).append(
+                            event['step'])
+                    if event['recipe_dir'] is not None:
+                        self.recipe_dirs[event['pn']] = event['recipe_dir']
+                elif event['event'] == 'commit':
+                    self.commits[event['pn']] = event['commit']
+                elif event['event'] == 'done':
+                    self.done[event['pn']] = event
+
+            self.cut = bool(line) and not line.endswith("\n")
+
+    def _write(self, event):
+        with self.lock:
+            with open(self.journal_file, "a") as f:
+                if self.cut:
+                    f.write("\n")
+                    self.cut = False
+                f.write(json.dumps(event) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+    def run(self, recipes):
+        self.recipes = recipes
+        self._write({'event': 'run', 'recipes': recipes})
+
+    def start(self, pn):
+        self._write({'event': 'start', 'pn': pn})
+
+    def step(self, pn, step, recipe_dir):
+        self._write({'event': 'step', 'pn': pn, 'step': step,
+                     'recipe_dir': recipe_dir})
+
+    def commit(self, pn, commit):
+        self._write({'event': 'commit', 'pn': pn, 'commit': commit})
+
+    def finish(self, pkg_ctx, succeeded):
+        error = None
+        if pkg_ctx.error is not None:
+            error = {'type': type(pkg_ctx.error).__name__,
+                     'message': pkg_ctx.error.message,
+                     'log_file': pkg_ctx.error.log_file}
+
+        self._write({'event': 'done', 'pn': pkg_ctx.pn,
+                     'succeeded': succeeded, 'error': error,
+                     'workdir': pkg_ctx.workdir,
+                     'recipe_dir': pkg_ctx.recipe_dir,
+                     'commit_msg': pkg_ctx.commit_msg,
+                     'patch_file': pkg_ctx.patch_file,
+                     'license_diff_fn': pkg_ctx.license_diff_fn})
+
+    def half_done(self):
+        """ Returns the recipes that were started but not finished. """
+        return [pn for pn in self.started if not pn in self.done]
+
+    def restore(self, pkg_ctx):
+        """ Fills pkg_ctx from its 'done' event, returns whether the upgrade
+            succeeded. """
+        event = self.done[pkg_ctx.pn]
+        pkg_ctx.workdir = event['workdir']
+        pkg_ctx.recipe_dir = event['recipe_dir']
+        pkg_ctx.commit_msg = event['commit_msg']
+        pkg_ctx.patch_file = event['patch_file']
+        pkg_ctx.license_diff_fn = event['license_diff_fn']
+        if event['error'] is not None:
+            pkg_ctx.error = restore_error(event['error']['type'],
+                    event['error']['message'], event['error']['log_file'])
+        return event['succeeded']
@@ -0,0 +1,143 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# vim: set ts=4 sw=4 et:
+#
+# This module implements a staged pipeline: every item goes through all
+# stages in turn, each stage has its own worker threads, so a slow stage
+# of one item overlaps with the other stages of the next ones.
+#
+
+import queue
+import threading
+import traceback
+import logging as log
+from logging import debug as D
+from logging import error as E
+
+class Stage(object):
+    def __init__(self, name, func, workers=1, ordered=False):
+        """ func(item, worker) is called for every item, worker is the
+            index of the thread running it. An ordered stage gets the
+            items in the order they were fed to the pipeline, it has a
+            single worker. """
+        self.name = name
+        self.func = func
+        self.workers = 1 if ordered else workers
+        self.ordered = ordered
+
+class Pipeline(object):
+    def __init__(self, stages, max_in_flight):
+        """ max_in_flight bounds the number of items that entered the first
+            stage and didn't leave the last one yet. """
+        self.stages = stages
+        self.max_in_flight = max_in_flight
+        self.error = None
+
+    def _process(self, stage, worker, index, item):
+        # once a stage failed unexpectedly the items only flow through so
+        # that the threads can finish
+        if self.error is not None:
+            return
+
+        try:
+            stage.func(item, worker)
+        except Exception as e:
+            E(" Pipeline stage %s failed:\n%s" % (stage.name,
+                traceback.format_exc()))
+            with self.lock:
+                if self.error is None:
+                    self.error = e
+
+    def _worker(self, i, worker):
+        stage = self.stages[i]
+        in_q = self.queues[i]
+        out_q = self.queues[i + 1] if i + 1 < len(self.stages) else None
+
+        pending = dict()
+        next_index = 0
+        while True:
+            entry = in_q.get()
+            if entry is None:
+                break
+
+            if stage.ordered:
+                pending[entry[0]] = entry[1]
+                ready = []
+                while next_index in pending:
+                    ready.append((next_index, pending.pop(next_index)))
+                    next_index += 1
+            else:
+                ready = [entry]
+
+            for index, item in ready:
+                self._process(stage, worker, index, item)
+                if out_q is not None:
+                    out_q.put((index, item))
+                else:
+                    with self.cond:
+                        self.done.add(index)
+                        self.cond.notify_all()
+                    self.in_flight.release()
+
+        with self.lock:
+            self.running[i] -= 1
+            last = self.running[i] == 0
+        if last and out_q is not None:
+            for w in range(self.stages[i + 1].workers):
+                out_q.put(None)
+
+    def _next(self, items, waiting, remaining):
+        """ Returns the index of the first item whose dependencies left
+            the pipeline, waiting for them if needed. """
+        with self.cond:
+            while True:
+                for index in remaining:
+                    if waiting[index] <= self.done:
+                        return index
+
+                # nothing can leave the pipeline, don't wait for it
+                fed = len(items) - len(remaining)
+                if self.error is not None or len(self.done) == fed:
+                    return remaining[0]
+                self.cond.wait()
+
+    def run(self, items, depends=None):
+        """ depends(item) returns the items that have to leave the
+            pipeline before item enters it. Items whose dependencies are
+            done enter in the order they are given. """
+        items = list(items)
+        self.lock = threading.Lock()
+        self.cond = threading.Condition(self.lock)
+        self.done = set()
+        self.in_flight = threading.Semaphore(self.max_in_flight)
+        self.queues = [queue.Queue() for s in self.stages]
+        self.running = [s.workers for s in self.stages]
+
+        threads = []
+        for i, stage in enumerate(self.stages):
+            for w in range(stage.workers):
+                t = threading.Thread(target=self._worker, args=(i, w),
+                        name="%s-%d" % (stage.name, w), daemon=True)
+                t.start()
+                threads.append(t)
+
+        indexes = dict((id(item), i) for i, item in enumerate(items))
+        waiting = []
+        for item in items:
+            deps = depends(item) if depends is not None else []
+            waiting.append(set(indexes[id(d)] for d in deps
+                if id(d) in indexes))
+
+        remaining = list(range(len(items)))
+        while remaining:
+            self.in_flight.acquire()
+            index = self._next(items, waiting, remaining)
+            remaining.remove(index)
+            self.queues[0].put((index, items[index]))
+        for w in range(self.stages[0].workers):
+            self.queues[0].put(None)
+
+        for t in threads:
+            t.join()
+
+        if self.error is not None:
+            raise self.error
@@ -0,0 +1,131 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# vim: set ts=4 sw=4 et:
+#
+# This module implements the pre-fetch of the new sources of the recipes to
+# upgrade. A single 'bitbake -k -c fetch' downloads all of them into DL_DIR,
+# with the new versions set through a postread configuration, so that
+# 'devtool upgrade' finds them there. It runs in its own build directory and
+# can go on while the main one is busy.
+#
+
+import os
+import threading
+import logging as log
+from logging import debug as D
+from logging import info as I
+from logging import warning as W
+
+from errors import *
+from utils.bitbake import *
+from utils.builddir import WorkerBuildDir
+
+PREFETCH_CLASS = "auh-prefetch"
+PREFETCH_LOG = "prefetch-log.txt"
+
+# Sets the version to upgrade to like 'devtool upgrade' does, the checksums
+# in the recipe are the ones of the current version.
+PREFETCH_CLASS_CONTENT = """# Generated by the Auto Upgrade Helper
+python () {
+    pv = d.getVar('AUH_PREFETCH_PV')
+    srcrev = d.getVar('AUH_PREFETCH_SRCREV')
+    if not pv and not srcrev:
+        return
+
+    if pv:
+        d.setVar('PV', pv)
+    if srcrev:
+        d.setVar('SRCREV', srcrev)
+
+    for flag in list((d.getVarFlags('SRC_URI') or {}).keys()):
+        if flag.endswith('sum'):
+            d.delVarFlag('SRC_URI', flag)
+    d.setVar('BB_STRICT_CHECKSUM', 'ignore')
+}
+"""
+
+class Prefetch(object):
+    def __init__(self, build_dir, base_env, workers):
+        self.workers = workers
+        self.builddir = WorkerBuildDir(get_build_dir(), build_dir, base_env)
+        self.thread = None
+
+    def _write_conf(self, pkgs_ctx):
+        classes_dir = os.path.join(self.builddir.build_dir, "classes")
+        if not os.path.exists(classes_dir):
+            os.makedirs(classes_dir)
+        with open(os.path.join(classes_dir, PREFETCH_CLASS + ".bbclass"),
+                "w") as f:
+            f.write(PREFETCH_CLASS_CONTENT)
+
+        conf = os.path.join(self.builddir.build_dir, "conf", "prefetch.conf")
+        with open(conf, "w") as f:
+            f.write("# Generated by the Auto Upgrade Helper\n")
+            f.write("BBPATH .= \":%s\"\n" % self.builddir.build_dir)
+            f.write("INHERIT += \"%s\"\n" % PREFETCH_CLASS)
+            f.write("BB_NUMBER_THREADS = \"%d\"\n" % self.workers)
+            for c in pkgs_ctx:
+                if not c.npv.endswith("new-commits-available"):
+                    f.write("AUH_PREFETCH_PV_pn-%s = \"%s\"\n" % (c.pn, c.npv))
+                if c.nsrcrev and c.nsrcrev != "N/A":
+                    f.write("AUH_PREFETCH_SRCREV_pn-%s = \"%s\"\n" %
+                            (c.pn, c.nsrcrev))
+
+        return conf
+
+    def _fetch(self, pkgs_ctx, log_dir):
+        I(" Pre-fetching the sources of %d recipes ..." % len(pkgs_ctx))
+        conf = self._write_conf(pkgs_ctx)
+        log_file = os.path.join(log_dir, PREFETCH_LOG)
+        try:
+            self.builddir.bb.fetch_all([c.pn for c in pkgs_ctx], conf,
+                    log_file=log_file)
+            failed = []
+        except Error as e:
+            with open(log_file, errors='replace') as log:
+                failed = failed_tasks(log)
+            if not failed:
+                W(" Pre-fetch failed, the sources will be fetched by"\
+                  " 'devtool upgrade'")
+
+        pkgs = dict((c.pn, c) for c in pkgs_ctx)
+        excerpts = dict()
+        for _, fn, task in failed:
+            pn = recipe_name(fn)
+            if not pn in pkgs or task != "do_fetch":
+                D(" Pre-fetch: ignoring failure of %s:%s" % (fn, task))
+                continue
+            excerpts[pn] = (fn, [])
+
+        # the log is read once more for the lines about the failed recipes
+        if excerpts:
+            with open(log_file, errors='replace') as log:
+                for line in log:
+                    for pn, (fn, excerpt) in excerpts.items():
+                        if fn in line or line.startswith("ERROR: %s-" % pn):
+                            excerpt.append(line.rstrip("\n"))
+
+        for pn, (fn, excerpt) in excerpts.items():
+            error = FetchError()
+            error.stdout = "\n".join(excerpt)
+            error.transient = transient_failure(error.stdout)
+            pkgs[pn].fetch_error = error
+            I(" %s: Pre-fetch FAILED!" % pn)
+
+    def _run(self, pkgs_ctx, log_dir):
+        try:
+            self._fetch(pkgs_ctx, log_dir)
+        except Exception as e:
+            import traceback
+            W(" Pre-fetch failed, the sources will be fetched by"\
+              " 'devtool upgrade':\n%s" % traceback.format_exc())
+
+    def start(self, pkgs_ctx, log_dir):
+        """ Fetches in the background, wait() for the results. """
+        self.thread = threading.Thread(target=self._run,
+                args=(pkgs_ctx, log_dir), name="prefetch", daemon=True)
+        self.thread.start()
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
@@ -0,0 +1,89 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# vim: set ts=4 sw=4 et:
+#
+# This module implements the ordering of the recipes to upgrade from the
+# dependency graph 'bitbake -g' writes: a recipe is upgraded after the
+# recipes it depends on, so it is built once against their new versions.
+#
+
+import os
+import re
+import heapq
+import logging as log
+from logging import debug as D
+
+TASK_DEPENDS = "task-depends.dot"
+
+TASK_EDGE = re.compile('^"(?P<pn>.+)\.do_[^"]+" -> "(?P<dep>.+)\.do_[^"]+"')
+
+def read_task_depends(dot_file):
+    """ Returns the recipes each recipe depends on, as found in the task
+        dependencies graph. The file is read line by line, it can be large. """
+    graph = dict()
+    with open(dot_file) as f:
+        for line in f:
+            m = TASK_EDGE.match(line)
+            if not m:
+                continue
+
+            pn = m.group('pn')
+            dep = m.group('dep')
+            if pn != dep:
+                graph.setdefault(pn, set()).add(dep)
+    return graph
+
+def _reachable(graph, pn, wanted):
+    """ Returns the recipes out of wanted pn depends on, directly or not. """
+    found = set()
+    seen = set([pn])
+    stack = [pn]
+    while stack:
+        for dep in graph.get(stack.pop(), ()):
+            if dep in seen:
+                continue
+            seen.add(dep)
+            if dep in wanted:
+                found.add(dep)
+            stack.append(dep)
+    return found
+
+def schedule(pns, graph):
+    """ Orders pns so that dependencies come first, otherwise keeping their
+        order. Returns the ordered list and, for every recipe, the ones
+        out of pns it has to wait for. """
+    wanted = set(pns)
+    position = dict((pn, i) for i, pn in enumerate(pns))
+    deps = dict((pn, _reachable(graph, pn, wanted)) for pn in pns)
+
+    waiting = dict((pn, set(deps[pn])) for pn in pns)
+    dependents = dict((pn, set()) for pn in pns)
+    for pn in pns:
+        for dep in deps[pn]:
+            dependents[dep].add(pn)
+
+    ready = [position[pn] for pn in pns if not waiting[pn]]
+    heapq.heapify(ready)
+    ordered = []
+    remaining = set(pns)
+    while remaining:
+        if not ready:
+            # a dependency loop, go on with the first recipe of it
+            pn = min(remaining, key=lambda p: position[p])
+            D(" Breaking a dependency loop at %s" % pn)
+            deps[pn] = deps[pn] - waiting[pn]
+            waiting[pn] = set()
+        else:
+            pn = pns[heapq.heappop(ready)]
+            if not pn in remaining:
+                continue
+
+        ordered.append(pn)
+        remaining.discard(pn)
+        for dependent in dependents[pn]:
+            if not dependent in remaining:
+                continue
+            waiting[dependent].discard(pn)
+            if not waiting[dependent]:
+                heapq.heappush(ready, position[dependent])
+
+    return ordered, deps
@@ -32,6 +32,10 @@ class Statistics(object):
         self.upgrade_stats = dict()
         self.maintainers = set()
         self.total_attempted = 0
+        self.deferred = []
+        self.build_costs = []
+        self.covered = []
+        self.retried = []
 
     def update(self, pn, new_ver, maintainer, error):
         if type(error).__name__ == "UpgradeNotNeededError":
@@ -63,6 +67,37 @@ class Statistics(object):
 
         self.total_attempted += 1
 
+    def defer(self, pn, new_ver, maintainer):
+        """ pn wasn't attempted because the run ran out of time """
+        self.deferred.append((pn, new_ver, maintainer))
+
+    def retry(self, pn, retries, error):
+        """ pn was attempted again after temporary failures """
+        status = "Succeeded" if error is None else str(error)
+        self.retried.append((pn, retries, status))
+
+    def cover(self, pn, covered_machines):
+        """ pn wasn't built for some machines, the build for another
+            machine of the same package architecture covers them """
+        for machine, by in sorted(covered_machines.items()):
+            self.covered.append((pn, machine, by))
+
+    def build_cost(self, pn, own, others, others_count):
+        """ own and others are the buildstats totals of pn and of the
+            other recipes its builds rebuilt """
+        self.build_costs.append((pn, own, others, others_count))
+
+    def _build_cost_stats(self):
+        stat_msg = "Build cost per recipe (wall-clock/CPU time of its tasks," \
+                   " of the other recipes rebuilt):\n\n"
+        for pn, own, others, others_count in sorted(self.build_costs,
+                key=lambda c: -(c[1]['elapsed'] + c[2]['elapsed'])):
+            stat_msg += "    %s: %.0fs/%.0fs, %d recipes rebuilt %.0fs/%.0fs\n" % \
+                        (pn, own['elapsed'], own['cpu'], others_count,
+                        others['elapsed'], others['cpu'])
+
+        return stat_msg + "\n"
+
     def _pkg_stats(self):
         stat_msg = "Recipe upgrade statistics:\n\n"
         for status in self.upgrade_stats:
@@ -86,6 +121,29 @@ class Statistics(object):
                     self.failed["total"],
                     percent_failed)
 
+        if self.retried:
+            stat_msg += "    Retried after temporary failures: %d\n" % \
+                        len(self.retried)
+            for pkg, retries, status in self.retried:
+                stat_msg += "        %s, %d retries, %s\n" % (pkg, retries,
+                            status)
+            stat_msg += "\n"
+
+        if self.covered:
+            stat_msg += "    Machine builds covered by another machine: %d\n" % \
+                        len(self.covered)
+            for pkg, machine, by in self.covered:
+                stat_msg += "        " + pkg + ", " + machine + " (by " + \
+                            by + ")\n"
+            stat_msg += "\n"
+
+        if self.deferred:
+            stat_msg += "    Not attempted, out of time: %d\n" % len(self.deferred)
+            for pkg, new_ver, maintainer in self.deferred:
+                stat_msg += "        " + pkg + ", " + new_ver + ", " + \
+                            maintainer + "\n"
+            stat_msg += "\n"
+
         return stat_msg
 
     def _maintainer_stats(self):
@@ -108,6 +166,8 @@ class Statistics(object):
                    "%s/%s, next are the statistics:\n\n" % (publish_work_url, workdir)
 
         msg += self._pkg_stats()
+        if self.build_costs:
+            msg += self._build_cost_stats()
         msg += self._maintainer_stats()
 
         return msg
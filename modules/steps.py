@@ -20,6 +20,7 @@
 #
 
 import os
+import time
 import sys
 import subprocess
 import shutil
@@ -32,112 +33,329 @@ from logging import error as E
 from logging import critical as C
 
 from errors import *
+from utils.bitbake import *
 from buildhistory import BuildHistory
+from attempts import attempt_key, ATTEMPT_ENV_VARIABLES
+from buildstats import BuildStats, buildstats_roots, recipe_cost, format_cost
+from failures import classify, MACHINE_INDEPENDENT_TASKS
+import tracing
+
+# recipe variables the upgrade steps use
+RECIPE_ENV_VARIABLES = ('FILE', 'PV', 'PACKAGE_ARCH', 'TUNE_PKGARCH',
+        'BUILD_ARCH') + ATTEMPT_ENV_VARIABLES
+
+DEVTOOL_UPGRADE_LOG = "devtool-upgrade-output.txt"
+
+def _arch_scope(env):
+    """ Tells whether a recipe builds the same for all machines (allarch
+        and native recipes), for the machines of the same tune, or is
+        specific to the machine. """
+    package_arch = env.get('PACKAGE_ARCH')
+    if package_arch == 'all':
+        return 'all'
+    if package_arch == env.get('TUNE_PKGARCH'):
+        return 'tune'
+    if package_arch == env.get('BUILD_ARCH'):
+        return 'all'
+    return 'machine'
 
 def load_env(devtool, bb, git, opts, pkg_ctx):
-    pkg_ctx['workdir'] = os.path.join(pkg_ctx['base_dir'], pkg_ctx['PN'])
-    os.mkdir(pkg_ctx['workdir'])
-    pkg_ctx['env'] = bb.env(pkg_ctx['PN'])
-    pkg_ctx['recipe_dir'] = os.path.dirname(pkg_ctx['env']['FILE'])
+    pkg_ctx.workdir = os.path.join(pkg_ctx.base_dir, pkg_ctx.pn)
+    os.mkdir(pkg_ctx.workdir)
+    env = bb.env(pkg_ctx.pn, RECIPE_ENV_VARIABLES)
+    pkg_ctx.recipe_dir = os.path.dirname(env['FILE'])
+    pkg_ctx.attempt_key = attempt_key(pkg_ctx.pn, pkg_ctx.pv, pkg_ctx.npv,
+            pkg_ctx.nsrcrev, env)
+    pkg_ctx.arch_scope = _arch_scope(env)
 
-    if pkg_ctx['env']['PV'] == pkg_ctx['NPV']:
+    if env['PV'] == pkg_ctx.npv:
         raise UpgradeNotNeededError
 
+def check_prefetch(devtool, bb, git, opts, pkg_ctx):
+    if pkg_ctx.fetch_error is not None:
+        raise pkg_ctx.fetch_error
+
 def buildhistory_init(devtool, bb, git, opts, pkg_ctx):
     if not opts['buildhistory']:
         return
 
-    pkg_ctx['buildhistory'] = BuildHistory(bb, pkg_ctx['PN'],
-            pkg_ctx['workdir'])
-    I(" %s: Initial buildhistory for %s ..." % (pkg_ctx['PN'],
+    pkg_ctx.buildhistory = BuildHistory(bb, pkg_ctx.pn,
+            pkg_ctx.workdir)
+    I(" %s: Initial buildhistory for %s ..." % (pkg_ctx.pn,
             opts['machines'][:1]))
-    pkg_ctx['buildhistory'].init(opts['machines'][:1])
+    pkg_ctx.buildhistory.init(opts['machines'][:1])
 
-def _extract_license_diff(devtool_output):
+def _extract_license_diff(devtool_log):
     licenseinfo = []
-    for line in devtool_output.split('\n'):
-        if line.startswith("NOTE: New recipe is"):
-            recipepath = line.split()[4]
-            with open(recipepath, 'rb') as f:
-                lines = f.readlines()
-
-            extracting = False
-            with open(recipepath, 'wb') as f:
-                for line in lines:
-                     if line.startswith(b'# FIXME: the LIC_FILES_CHKSUM'):
-                         extracting = True
-                     elif extracting == True and not line.startswith(b'#') and len(line) > 1:
-                         extracting = False
-                     if extracting == True:
-                         licenseinfo.append(line[2:])
-                     else:
-                         f.write(line)
+    with open(devtool_log, errors='replace') as log:
+        recipepaths = [line.split()[4] for line in log
+                if line.startswith("NOTE: New recipe is")]
+
+    for recipepath in recipepaths:
+        with open(recipepath, 'rb') as f:
+            lines = f.readlines()
+
+        extracting = False
+        with open(recipepath, 'wb') as f:
+            for line in lines:
+                 if line.startswith(b'# FIXME: the LIC_FILES_CHKSUM'):
+                     extracting = True
+                 elif extracting == True and not line.startswith(b'#') and len(line) > 1:
+                     extracting = False
+                 if extracting == True:
+                     licenseinfo.append(line[2:])
+                 else:
+                     f.write(line)
     D(" License diff extracted: {}".format(b"".join(licenseinfo).decode('utf-8')))
     return licenseinfo
 
 def devtool_upgrade(devtool, bb, git, opts, pkg_ctx):
-    if pkg_ctx['NPV'].endswith("new-commits-available"):
-        pkg_ctx['commit_msg'] = "{}: upgrade to latest revision".format(pkg_ctx['PN'])
+    if pkg_ctx.npv.endswith("new-commits-available"):
+        pkg_ctx.commit_msg = "{}: upgrade to latest revision".format(pkg_ctx.pn)
     else:
-        pkg_ctx['commit_msg'] = "{}: upgrade {} -> {}".format(pkg_ctx['PN'], pkg_ctx['PV'], pkg_ctx['NPV'])
+        pkg_ctx.commit_msg = "{}: upgrade {} -> {}".format(pkg_ctx.pn, pkg_ctx.pv, pkg_ctx.npv)
 
+    devtool_log = os.path.join(pkg_ctx.workdir, DEVTOOL_UPGRADE_LOG)
     try:
-        devtool_output = devtool.upgrade(pkg_ctx['PN'], pkg_ctx['NPV'], pkg_ctx['NSRCREV'])
+        devtool_output = devtool.upgrade(pkg_ctx.pn, pkg_ctx.npv,
+                pkg_ctx.nsrcrev, log_file=devtool_log)
         D(" 'devtool upgrade' printed:\n%s" %(devtool_output))
         # If devtool failed to rebase patches, it does not fail, but we should
-        if 'conflict' in devtool_output:
-            raise DevtoolError("Running 'devtool upgrade' for recipe %s failed." %(pkg_ctx['PN']), devtool_output)
-    except DevtoolError as e1:
+        with open(devtool_log, errors='replace') as log:
+            conflict = any('conflict' in line for line in log)
+        if conflict:
+            raise DevtoolError("Running 'devtool upgrade' for recipe %s failed." %(pkg_ctx.pn), devtool_output)
+    except (DevtoolError, CommandTimeoutError) as e1:
         try:
-            devtool_output = devtool.reset(pkg_ctx['PN'])
+            devtool_output = devtool.reset(pkg_ctx.pn)
             _rm_source_tree(devtool_output)
-        except DevtoolError as e2:
+        except (DevtoolError, CommandTimeoutError) as e2:
             pass
         raise e1
 
-    license_diff_info = _extract_license_diff(devtool_output)
+    license_diff_info = _extract_license_diff(devtool_log)
+    # the output is only worth keeping when the upgrade failed
+    os.remove(devtool_log)
     if len(license_diff_info) > 0:
-        pkg_ctx['license_diff_fn'] = "license-diff.txt"
-        with open(os.path.join(pkg_ctx['workdir'], pkg_ctx['license_diff_fn']), 'wb') as f:
+        pkg_ctx.license_diff_fn = "license-diff.txt"
+        with open(os.path.join(pkg_ctx.workdir, pkg_ctx.license_diff_fn), 'wb') as f:
             f.write(b"".join(license_diff_info))
 
 
+def _compile_log(workdir, machine):
+    return "{}/bitbake-output-{}.txt".format(workdir, machine)
+
+def _check_compile_log(log_file, pkg, machine):
+    """ Reads the output of a failed build, returns the Failure or None
+        if it isn't a real failure """
+    with open(log_file, errors='replace') as log:
+        return classify(log, pkg, machine)
+
 def _compile(bb, pkg, machine, workdir):
-        try:
-            bb.complete(pkg, machine)
-        except Error as e:
-            with open("{}/bitbake-output-{}.txt".format(workdir, machine), 'w') as f:
-                f.write(e.stdout)
-            for line in e.stdout.split("\n"):
-                # version going backwards is not a real error
-                if re.match(".* went backwards which would break package feeds .*", line):
-                    break
-                # 'not in COMPATIBLE_HOST/MACHINE is not a real error
-                if re.match(".*not in COMPATIBLE.*", line):
-                    break
-                # 'Nothing PROVIDES' is not a real error
-                if re.match(".*Nothing PROVIDES.*", line):
-                    break
-            else:
-                raise CompilationError()
+    """ Returns the Failure of the build if it failed, its output is kept
+        in the work directory """
+    log_file = _compile_log(workdir, machine)
+    try:
+        bb.complete(pkg, machine, log_file=log_file)
+    except CommandTimeoutError:
+        raise
+    except Error:
+        return _check_compile_log(log_file, pkg, machine)
+    os.remove(log_file)
+    return None
+
+def _machine_specific(pkg_ctx, task, fp, machine):
+    """ Whether previous runs showed the failure on machine only, the
+        other machines are worth building then. Other failures stop the
+        build at the first failing machine. """
+    if pkg_ctx.arch_scope == 'all' or task in MACHINE_INDEPENDENT_TASKS:
+        return False
+    if not fp in pkg_ctx.known_fingerprints:
+        return False
+    # nor did it happen on another machine in this run
+    machines = set(pkg_ctx.known_fingerprints[fp])
+    machines.update(m for m, _, f in pkg_ctx.failures if f == fp)
+    return machines == set([machine])
+
+def _save_machine_log(log_file, machine, machine_log):
+    # keep the lines about this machine and the ones not about any
+    # multiconfig (summary, errors about the recipe itself)
+    mc = multiconfig_name(machine)
+    with open(log_file, errors='replace') as log, open(machine_log, 'w') as f:
+        for line in log:
+            if "mc:" + MULTICONFIG_PREFIX in line or "tmp-" + MULTICONFIG_PREFIX in line:
+                if not ("mc:%s:" % mc in line or "tmp-%s/" % mc in line):
+                    continue
+            f.write(line)
+
+def _compile_multiconfig(bb, pkg, machines, workdir):
+    """ Builds pkg for all machines at once. Returns the machines that
+        failed, each one with its output in its own log, or None if the
+        failures couldn't be attributed to machines and a build per machine
+        is needed. """
+    log_file = _compile_log(workdir, "multiconfig")
+    try:
+        bb.complete_multiconfig(pkg, machines, log_file=log_file)
+    except CommandTimeoutError:
+        raise
+    except Error:
+        with open(log_file, errors='replace') as log:
+            failed_mcs = set(mc for mc, _, _ in failed_tasks(log))
+
+        failed = None
+        if failed_mcs and not None in failed_mcs:
+            failed = [m for m in machines if multiconfig_name(m) in failed_mcs]
+            for machine in failed:
+                _save_machine_log(log_file, machine,
+                        _compile_log(workdir, machine))
+        os.remove(log_file)
+        return failed
+
+    os.remove(log_file)
+    return []
+
+def _buildstats(bb):
+    try:
+        tmpdir = bb.tmpdir()
+    except Error as e:
+        D(" Can't find TMPDIR, no buildstats: %s" % e.message)
+        return BuildStats([])
+    return BuildStats(buildstats_roots(tmpdir, bb.build_dir))
+
+def _save_build_cost(pkg_ctx, machine, tasks):
+    if not tasks:
+        return
+
+    cost = recipe_cost(pkg_ctx.pn, tasks)
+    pkg_ctx.build_costs[machine] = cost
+    with open(os.path.join(pkg_ctx.workdir, "buildstats-%s.txt" % machine),
+            'w') as f:
+        f.write(format_cost(pkg_ctx.pn, cost))
+
+def _save_multiconfig_build_costs(bb, pkg_ctx, machines, tasks):
+    """ Each machine of a multiconfig build has its own TMPDIR """
+    for machine in machines:
+        tmpdir = os.path.join(bb.build_dir, "tmp-" + multiconfig_name(machine))
+        _save_build_cost(pkg_ctx, machine, tasks.pop(tmpdir, []))
+    _save_build_cost(pkg_ctx, "multiconfig",
+            [t for build in tasks.values() for t in build])
+
+def _build_machines(opts, pkg_ctx):
+    """ Returns the machines pkg_ctx has to be built for, the other ones
+        are covered by the build of a machine with the same package
+        architecture. """
+    if pkg_ctx.arch_scope == 'all':
+        key = lambda m: None
+    elif pkg_ctx.arch_scope == 'tune':
+        key = lambda m: opts['machine_tunes'].get(m, m)
+    else:
+        return opts['machines']
+
+    machines = []
+    built = dict()
+    for machine in opts['machines']:
+        k = key(machine)
+        if k in built:
+            pkg_ctx.covered_machines[machine] = built[k]
+        else:
+            built[k] = machine
+            machines.append(machine)
+
+    for machine, by in pkg_ctx.covered_machines.items():
+        I(" %s: not building for %s, the build for %s covers it" % (
+                pkg_ctx.pn, machine, by))
+    return machines
+
+def _wait_gcc_runtimes(opts, pkg_ctx, machines):
+    """ The gcc runtimes are built in the background, a machine is built
+        for once its own one is ready """
+    for machine in machines:
+        ready = opts['gcc_runtime_ready'].get(machine)
+        if ready is not None and not ready.is_set():
+            D(" %s: waiting for the gcc runtime of %s" % (pkg_ctx.pn,
+                    machine))
+            ready.wait()
 
 def compile(devtool, bb, git, opts, pkg_ctx):
     if opts['skip_compilation']:
-        W(" %s: Compilation was skipped by user choice!" % pkg_ctx['PN'])
+        W(" %s: Compilation was skipped by user choice!" % pkg_ctx.pn)
         return
 
-    for machine in opts['machines']:
-        I(" %s: compiling upgraded version for %s ..." % (pkg_ctx['PN'], machine))
-        _compile(bb, pkg_ctx['PN'], machine, pkg_ctx['workdir'])
-        if opts['buildhistory']:
-            pkg_ctx['buildhistory'].add()
+    build_stats = _buildstats(bb)
+    machines = opts['machines']
+    if opts['build_once_per_arch']:
+        machines = _build_machines(opts, pkg_ctx)
+
+    failed = None
+    if opts['parallel_machines'] and len(machines) > 1:
+        I(" %s: compiling upgraded version for %s ..." % (pkg_ctx.pn,
+                ' '.join(machines)))
+        _wait_gcc_runtimes(opts, pkg_ctx, machines)
+        started = time.time()
+        with tracing.span("compile", "machine", pn=pkg_ctx.pn,
+                machine="multiconfig"):
+            failed = _compile_multiconfig(bb, pkg_ctx.pn, machines,
+                    pkg_ctx.workdir)
+        pkg_ctx.timings.append(("compile", "multiconfig", started,
+                time.time() - started))
+        _save_multiconfig_build_costs(bb, pkg_ctx, machines,
+                build_stats.collect())
+        if failed is None:
+            W(" %s: multiconfig build failed, building each machine" \
+              " separately ..." % pkg_ctx.pn)
+
+    if failed is None and pkg_ctx.machine_order is not None:
+        machines = [m for m in pkg_ctx.machine_order if m in machines]
+
+    error = None
+    for machine in machines:
+        failure = None
+        if failed is None:
+            _wait_gcc_runtimes(opts, pkg_ctx, [machine])
+            I(" %s: compiling upgraded version for %s ..." % (pkg_ctx.pn, machine))
+            started = time.time()
+            try:
+                with tracing.span("compile", "machine", pn=pkg_ctx.pn,
+                        machine=machine):
+                    failure = _compile(bb, pkg_ctx.pn, machine,
+                            pkg_ctx.workdir)
+            finally:
+                pkg_ctx.timings.append(("compile", machine, started,
+                        time.time() - started))
+                _save_build_cost(pkg_ctx, machine, [t for build in
+                        build_stats.collect().values() for t in build])
+        elif machine in failed:
+            failure = _check_compile_log(_compile_log(pkg_ctx.workdir,
+                    machine), pkg_ctx.pn, machine)
+
+        if failure is None:
+            if opts['buildhistory']:
+                pkg_ctx.buildhistory.add()
+            continue
+
+        task, fp = failure.task, failure.fingerprint
+        pkg_ctx.failures.append((machine, task, fp))
+        D(" %s: %s failed on %s, fingerprint %s" % (pkg_ctx.pn, task,
+                machine, fp))
+        if error is None:
+            error = failure.error()
+        if failed is None and not _machine_specific(pkg_ctx, task, fp,
+                machine):
+            break
+        if failed is None and machine != machines[-1]:
+            I(" %s: the failure on %s was specific to it before, building"\
+              " the other machines" % (pkg_ctx.pn, machine))
+
+    if error is not None:
+        error.message += " for " + ' '.join(m for m, _, _ in pkg_ctx.failures)
+        raise error
 
 def buildhistory_diff(devtool, bb, git, opts, pkg_ctx):
     if not opts['buildhistory']:
         return
 
-    I(" %s: Checking buildhistory ..." % pkg_ctx['PN'])
-    pkg_ctx['buildhistory'].diff()
+    I(" %s: Checking buildhistory ..." % pkg_ctx.pn)
+    pkg_ctx.buildhistory.diff()
 
 def _rm_source_tree(devtool_output):
     for line in devtool_output.split("\n"):
@@ -145,24 +363,46 @@ def _rm_source_tree(devtool_output):
             srctree = line.split()[4]
             shutil.rmtree(srctree)
 
+def devtool_reset(devtool, pn):
+    """ Drops pn from the devtool workspace along with its source tree """
+    devtool_output = devtool.reset(pn)
+    _rm_source_tree(devtool_output)
+
 def devtool_finish(devtool, bb, git, opts, pkg_ctx):
     try:
-        devtool_output = devtool.finish(pkg_ctx['PN'], pkg_ctx['recipe_dir'])
+        devtool_output = devtool.finish(pkg_ctx.pn, pkg_ctx.recipe_dir)
         _rm_source_tree(devtool_output)
         D(" 'devtool finish' printed:\n%s" %(devtool_output))
-    except DevtoolError as e1:
+    except (DevtoolError, CommandTimeoutError) as e1:
         try:
-            devtool_output = devtool.reset(pkg_ctx['PN'])
+            devtool_output = devtool.reset(pkg_ctx.pn)
             _rm_source_tree(devtool_output)
-        except DevtoolError as e2:
+        except (DevtoolError, CommandTimeoutError) as e2:
             pass
         raise e1
 
 upgrade_steps = [
     (load_env, "Loading environment ..."),
+    (check_prefetch, None),
     (buildhistory_init, None),
     (devtool_upgrade, "Running 'devtool upgrade' ..."),
     (devtool_finish, "Running 'devtool finish' ..."),
     (compile, None),
     (buildhistory_diff, None),
 ]
+
+# When upgrades are pipelined the first steps run on a worker build
+# directory, only touching its devtool workspace, while the main build
+# directory runs the others for the previous recipes, in order.
+upgrade_stage_steps = [
+    (load_env, "Loading environment ..."),
+    (check_prefetch, None),
+    (devtool_upgrade, "Running 'devtool upgrade' ..."),
+]
+
+compile_stage_steps = [
+    (buildhistory_init, None),
+    (devtool_finish, "Running 'devtool finish' ..."),
+    (compile, None),
+    (buildhistory_diff, None),
+]
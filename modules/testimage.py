@@ -37,7 +37,7 @@ from utils.bitbake import *
 
 def _pn_in_pkgs_ctx(pn, pkgs_ctx):
     for c in pkgs_ctx:
-        if pn == c['PN']:
+        if pn == c.pn:
             return c
     return None
 
@@ -51,7 +51,8 @@ class TestImage():
         self.image = image
 
         self.logdir = os.path.join(uh_work_dir, "testimage-logs")
-        os.mkdir(self.logdir)
+        if not os.path.exists(self.logdir):
+            os.mkdir(self.logdir)
 
         os.environ['BB_ENV_EXTRAWHITE'] = os.environ['BB_ENV_EXTRAWHITE'] + \
             " CORE_IMAGE_EXTRA_INSTALL TEST_LOG_DIR TESTIMAGE_UPDATE_VARS"
@@ -60,12 +61,12 @@ class TestImage():
         pkgs_out = []
 
         for c in pkgs:
-            pkgs_out.append(c['PN'])
+            pkgs_out.append(c.pn)
 
-            I(" Checking if package {} has ptests...".format(c['PN']))
-            if 'PTEST_ENABLED' in self.bb.env(c['PN']):
+            I(" Checking if package {} has ptests...".format(c.pn))
+            if 'PTEST_ENABLED' in self.bb.env(c.pn, ['PTEST_ENABLED']):
                 I("  ...yes")
-                pkgs_out.append((c['PN']) + '-ptest')
+                pkgs_out.append((c.pn) + '-ptest')
             else:
                 I("  ...no")
 
@@ -79,27 +80,22 @@ class TestImage():
         I( " Installing additional packages to the image: {}".format(os.environ['CORE_IMAGE_EXTRA_INSTALL']))
 
         I( "   building %s for %s ..." % (image, machine))
-        bitbake_create_output = ""
-        bitbake_run_output = ""
         try:
-            bitbake_create_output = self.bb.complete(image, machine)
+            self.bb.complete(image, machine, operation="testimage",
+                    log_file=os.path.join(self.logdir,
+                        "bitbake-create-testimage.log"))
         except Error as e:
             I( "   building the testimage failed! Collecting logs...")
-            bitbake_create_output = e.stdout
         else:
             I( "   running %s/testimage for %s ..." % (image, machine))
             try:
-                bitbake_run_output = self.bb.complete("%s -c testimage" % image, machine)
+                self.bb.complete("%s -c testimage" % image, machine,
+                        operation="testimage",
+                        log_file=os.path.join(self.logdir,
+                            "bitbake-run-testimage.log"))
             except Error as e:
                 I( "   running the testimage failed! Collecting logs...")
-                bitbake_run_output = e.stdout
 
-        if bitbake_create_output:
-            with open(os.path.join(self.logdir, "bitbake-create-testimage.log"), 'w') as f:
-                f.write(bitbake_create_output)
-        if bitbake_run_output:
-            with open(os.path.join(self.logdir, "bitbake-run-testimage.log"), 'w') as f:
-                f.write(bitbake_run_output)
         I(" All done! Testimage/ptest/qemu logs are collected to {}".format(self.logdir))
 
     def run(self):
@@ -0,0 +1,94 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# vim: set ts=4 sw=4 et:
+#
+# This module implements the database of how long the upgrade steps took,
+# per recipe and per machine, across runs. It is used to estimate how long
+# upgrading a recipe takes.
+#
+
+import sqlite3
+import threading
+import logging as log
+from logging import debug as D
+
+# runs a recipe estimate is based on
+TIMINGS_HISTORY = 5
+
+TIMINGS_SCHEMA = """CREATE TABLE IF NOT EXISTS timings (
+    run TEXT NOT NULL,
+    pn TEXT NOT NULL,
+    step TEXT NOT NULL,
+    machine TEXT,
+    started REAL NOT NULL,
+    seconds REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS timings_pn ON timings (pn, run);
+"""
+
+def format_duration(seconds):
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return "%d:%02d:%02d" % (hours, minutes, seconds)
+
+class Timings(object):
+    def __init__(self, db_file, run):
+        self.run = run
+        self.lock = threading.Lock()
+        # recipes finish in several threads, they take turns on self.lock
+        self.db = sqlite3.connect(db_file, check_same_thread=False)
+        self.db.executescript(TIMINGS_SCHEMA)
+
+        super(Timings, self).__init__()
+
+    def record(self, pkg_ctx):
+        """ Stores the timings of pkg_ctx, (step, machine, started, seconds)
+            with machine None for the whole step. """
+        with self.lock, self.db:
+            self.db.executemany("INSERT INTO timings VALUES (?, ?, ?, ?, ?, ?)",
+                    [(self.run, pkg_ctx.pn, step, machine, started, seconds)
+                     for step, machine, started, seconds in pkg_ctx.timings])
+
+    def forget(self, pn):
+        """ Drops the timings of pn in this run, it is upgraded again """
+        with self.lock, self.db:
+            self.db.execute("DELETE FROM timings WHERE run = ? AND pn = ?",
+                    (self.run, pn))
+
+    def estimate(self, pn):
+        """ Returns the average time upgrading pn took in the last runs, or
+            None if it was never upgraded. """
+        with self.lock:
+            rows = self.db.execute("SELECT SUM(seconds) FROM timings"
+                    " WHERE pn = ? AND machine IS NULL AND run != ?"
+                    " GROUP BY run ORDER BY MAX(started) DESC LIMIT ?",
+                    (pn, self.run, TIMINGS_HISTORY)).fetchall()
+
+        if not rows:
+            return None
+        return sum(r[0] for r in rows) / len(rows)
+
+    def last_attempt(self, pn):
+        """ Returns when pn was upgraded last, before this run, or None """
+        with self.lock:
+            row = self.db.execute("SELECT MAX(started) FROM timings"
+                    " WHERE pn = ? AND run != ?", (pn, self.run)).fetchone()
+        return row[0]
+
+    def estimates(self, pns):
+        """ Returns the estimate of every recipe of pns. Recipes that were
+            never upgraded get the median of the others. """
+        estimates = dict((pn, self.estimate(pn)) for pn in pns)
+
+        known = sorted(e for e in estimates.values() if e is not None)
+        if known:
+            median = known[len(known) // 2]
+            for pn in pns:
+                if estimates[pn] is None:
+                    estimates[pn] = median
+        D(" Timings: %d of %d recipes upgraded before" % (len(known),
+                len(pns)))
+        return estimates, len(known)
+
+    def close(self):
+        with self.lock:
+            self.db.close()
@@ -0,0 +1,122 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# vim: set ts=4 sw=4 et:
+#
+# This module implements the tracing of a run (--trace): the time spent in
+# every step, command, machine build and in the work around them is recorded
+# as spans, written in the Chrome trace event format (chrome://tracing or
+# https://ui.perfetto.dev can open it) and summarized as text.
+# Nothing is recorded when tracing isn't enabled.
+#
+
+import os
+import json
+import time
+import threading
+import logging as log
+from logging import debug as D
+
+# spans listed per category in the summary
+TRACE_SUMMARY_TOP = 15
+
+_events = None
+_threads = dict()
+_lock = threading.Lock()
+_started = None
+
+class _Span(object):
+    def __init__(self, name, cat, args):
+        self.name = name
+        self.cat = cat
+        self.args = args
+
+    def __enter__(self):
+        self.started = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        _add(self.name, self.cat, self.started, time.perf_counter(),
+                self.args)
+        return False
+
+class _NullSpan(object):
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+_NULL_SPAN = _NullSpan()
+
+def enable():
+    global _events, _started
+    _events = []
+    _started = time.perf_counter()
+
+def enabled():
+    return _events is not None
+
+def span(name, cat, **args):
+    """ Returns a context manager recording the time spent in it, args
+        (e.g. pn, machine) are attached to the span. """
+    if _events is None:
+        return _NULL_SPAN
+    return _Span(name, cat, args)
+
+def _add(name, cat, started, ended, args):
+    thread = threading.current_thread()
+    with _lock:
+        if not thread.ident in _threads:
+            _threads[thread.ident] = (len(_threads) + 1, thread.name)
+        _events.append({'name': name, 'cat': cat, 'ph': 'X',
+                        'ts': int((started - _started) * 1000000),
+                        'dur': int((ended - started) * 1000000),
+                        'pid': os.getpid(), 'tid': _threads[thread.ident][0],
+                        'args': args})
+
+def write(trace_file):
+    with _lock:
+        events = list(_events)
+        events += [{'name': 'thread_name', 'ph': 'M', 'pid': os.getpid(),
+                    'tid': tid, 'args': {'name': name}}
+                   for tid, name in _threads.values()]
+
+    with open(trace_file, "w") as f:
+        json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, f)
+    D(" Trace written to %s" % trace_file)
+
+def _top(totals, title):
+    msg = "%s:\n" % title
+    top = sorted(totals.items(), key=lambda t: -t[1][0])[:TRACE_SUMMARY_TOP]
+    for name, (seconds, count) in top:
+        msg += "    %10.1fs %6d  %s\n" % (seconds, count, name)
+    return msg + "\n"
+
+def summary():
+    """ Returns where the time went, the spans taking the most time in each
+        category, then the recipes and machines taking the most time. """
+    with _lock:
+        events = list(_events)
+    wall = time.perf_counter() - _started
+
+    by_cat = dict()
+    recipes = dict()
+    machines = dict()
+    for e in events:
+        seconds = e['dur'] / 1000000.0
+        for totals, key in ((by_cat.setdefault(e['cat'], dict()), e['name']),
+                (recipes, e['args'].get('pn') if e['cat'] == 'step' else None),
+                (machines, e['args'].get('machine'))):
+            if key is None:
+                continue
+            total, count = totals.get(key, (0, 0))
+            totals[key] = (total + seconds, count + 1)
+
+    msg = "Trace summary, %.1fs wall-clock time (total, count, span):\n\n" \
+            % wall
+    for cat in sorted(by_cat):
+        msg += _top(by_cat[cat], "Top %s spans" % cat)
+    if recipes:
+        msg += _top(recipes, "Top recipes (steps)")
+    if machines:
+        msg += _top(machines, "Top machines")
+    return msg
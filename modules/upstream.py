@@ -0,0 +1,198 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# vim: set ts=4 sw=4 et:
+#
+# This module implements the upstream version checks of the recipes, like
+# oe.recipeutils.get_recipe_upgrade_status() does, with the results cached
+# for a while. A recipe is only checked again once its entry expired or
+# anything the check depends on (SRC_URI, PV, SRCREV, UPSTREAM_CHECK_*, ...)
+# changed.
+#
+
+import os
+import json
+import time
+import hashlib
+import tempfile
+import logging as log
+from logging import debug as D
+from logging import info as I
+from logging import warning as W
+
+from errors import *
+from utils.bitbake import *
+
+UPSTREAM_CACHE_VERSION = 1
+
+# variables the upstream check reads, as oe.recipeutils copies them
+UPSTREAM_VARIABLES = ('SRC_URI', 'PV', 'GITDIR', 'DL_DIR', 'PN', 'CACHE',
+        'PERSISTENT_DIR', 'BB_URI_HEADREVS', 'UPSTREAM_CHECK_COMMITS',
+        'UPSTREAM_CHECK_GITTAGREGEX', 'UPSTREAM_CHECK_REGEX',
+        'UPSTREAM_CHECK_URI', 'UPSTREAM_VERSION_UNKNOWN', 'RECIPE_MAINTAINER',
+        'RECIPE_NO_UPDATE_REASON', 'RECIPE_UPSTREAM_VERSION',
+        'RECIPE_UPSTREAM_DATE', 'CHECK_DATE', 'FETCHCMD_bzr', 'FETCHCMD_ccrypt',
+        'FETCHCMD_cvs', 'FETCHCMD_git', 'FETCHCMD_hg', 'FETCHCMD_npm',
+        'FETCHCMD_osc', 'FETCHCMD_p4', 'FETCHCMD_repo', 'FETCHCMD_s3',
+        'FETCHCMD_svn', 'FETCHCMD_wget')
+
+# variables that change without the upstream check result changing
+UPSTREAM_KEY_EXCLUDED = ('CHECK_DATE',)
+
+# results that are checked again on the next run whatever the TTL is
+UPSTREAM_UNCACHED_STATUS = ('UNKNOWN_BROKEN',)
+
+class UpstreamCheck(object):
+    def __init__(self, tinfoil, cache_file, ttl, workers, refresh=False):
+        """ ttl is the time (in hours) a result is reused, 0 disables the
+            cache. workers is the number of processes checking upstream. """
+        self.tinfoil = tinfoil
+        self.cache_file = cache_file
+        self.ttl = ttl * 3600
+        self.workers = workers
+        self.refresh = refresh
+
+        self.entries = self._load()
+        self.cached = []
+        self.pending = []
+
+        super(UpstreamCheck, self).__init__()
+
+    def _load(self):
+        if self.ttl <= 0 or not os.path.exists(self.cache_file):
+            return dict()
+
+        try:
+            with open(self.cache_file) as f:
+                cache = json.load(f)
+        except (OSError, ValueError) as e:
+            W(" Ignoring upstream version cache %s: %s" % (self.cache_file, e))
+            return dict()
+
+        if cache.get('version') != UPSTREAM_CACHE_VERSION:
+            return dict()
+        return cache['entries']
+
+    def _save(self):
+        cache_dir = os.path.dirname(self.cache_file)
+        fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({'version': UPSTREAM_CACHE_VERSION,
+                       'entries': self.entries}, f)
+        os.replace(tmp, self.cache_file)
+
+    def _key(self, data):
+        h = hashlib.sha256()
+        for var in sorted(data.keys()):
+            if var in UPSTREAM_KEY_EXCLUDED:
+                continue
+            h.update(("%s=%s\n" % (var, data.getVar(var))).encode('utf-8'))
+        return h.hexdigest()
+
+    def _data_copy(self, data):
+        data_copy = bb.data.init()
+        for var in UPSTREAM_VARIABLES:
+            data_copy.setVar(var, data.getVar(var))
+        for var in data:
+            if var.startswith('SRCREV'):
+                data_copy.setVar(var, data.getVar(var))
+        return data_copy
+
+    def prepare(self, recipes):
+        """ Parses recipes (names or files, all recipes if empty) and looks
+            up their cached results. Returns the number of recipes that need
+            to be checked upstream. """
+        import bb.data
+        import bb.providers
+
+        tinfoil = self.tinfoil.get()
+        if tinfoil is None:
+            raise Error("Can't parse the recipes to check upstream")
+
+        if not recipes:
+            recipes = tinfoil.all_recipe_files(variants=False)
+
+        now = time.time()
+        for fn in recipes:
+            try:
+                if fn.startswith("/"):
+                    data = tinfoil.parse_recipe_file(fn)
+                else:
+                    data = tinfoil.parse_recipe(fn)
+            except bb.providers.NoProvider:
+                I(" No provider for %s" % fn)
+                continue
+
+            pn = data.getVar('PN')
+            if data.getVar('UPSTREAM_CHECK_UNRELIABLE') == "1":
+                I(" Skip package %s as upstream check unreliable" % pn)
+                continue
+
+            data_copy = self._data_copy(data)
+            key = self._key(data_copy)
+            entry = self.entries.get(pn)
+            if not self.refresh and entry is not None and \
+                    entry['key'] == key and now - entry['time'] < self.ttl:
+                self.cached.append(tuple(entry['status']))
+            else:
+                self.pending.append((key, data_copy))
+
+        # the checks don't need the bitbake server
+        self.tinfoil.release()
+
+        D(" Upstream versions: %d cached, %d to check" %
+                (len(self.cached), len(self.pending)))
+        return len(self.pending)
+
+    def check(self, upgrade_found=None):
+        """ Checks the recipes prepare() couldn't find in the cache and
+            returns the status of all of them as
+            get_recipe_upgrade_status() does. upgrade_found() is called
+            while the checks go on, the first time a recipe has a new
+            version, bitbake is free to use from then on. """
+        import oe.recipeutils
+
+        def _has_upgrade(statuses):
+            return any(s[1] == 'UPDATE' for s in statuses)
+
+        checked = []
+        if self.pending and \
+                not hasattr(oe.recipeutils, '_get_recipe_upgrade_status'):
+            # older OE-Core only checks whole lists of recipes
+            I(" Checking upstream versions of %d recipes ..." %
+                    len(self.pending))
+            pns = [data_copy.getVar('PN') for _, data_copy in self.pending]
+            checked = list(oe.recipeutils.get_recipe_upgrade_status(pns))
+            keys = dict((data_copy.getVar('PN'), key)
+                    for key, data_copy in self.pending)
+            self.pending = [(keys.get(s[0]), None) for s in checked]
+        elif self.pending:
+            I(" Checking upstream versions of %d recipes ..." %
+                    len(self.pending))
+            from concurrent.futures import ProcessPoolExecutor
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+                # the processes are forked as the work is submitted, before
+                # any other thread starts
+                results = executor.map(
+                    oe.recipeutils._get_recipe_upgrade_status,
+                    [data_copy for _, data_copy in self.pending])
+                found = upgrade_found is None
+                if not found and _has_upgrade(self.cached):
+                    upgrade_found()
+                    found = True
+                # the results come in order, as the checks finish
+                for status in results:
+                    checked.append(status)
+                    if not found and _has_upgrade([status]):
+                        upgrade_found()
+                        found = True
+
+        if self.ttl > 0:
+            now = time.time()
+            for (key, _), status in zip(self.pending, checked):
+                if key is None or status[1] in UPSTREAM_UNCACHED_STATUS:
+                    self.entries.pop(status[0], None)
+                    continue
+                self.entries[status[0]] = {'key': key, 'time': now,
+                        'status': list(status)}
+            self._save()
+
+        return self.cached + checked
@@ -31,26 +31,111 @@ from logging import error as E
 from logging import critical as C
 import sys
 import re
+import subprocess
+import collections
+import threading
 
 from errors import *
+from utils.envcache import ENV_CACHE_VARIABLES
 
 for path in os.environ["PATH"].split(':'):
     if os.path.exists(path) and "bitbake" in os.listdir(path):
         sys.path.insert(0, os.path.join(path, "../lib"))
         import bb
 
+from utils import process
+import tracing
+
 BITBAKE_ERROR_LOG = 'bitbake_error_log.txt'
 
+# lines of 'bitbake -e' output kept to report an empty environment
+ENV_OUTPUT_TAIL = 200
+
+ENV_ASSIGNMENT = re.compile("^([^ \t=]*)=(.*)")
+
+# multiconfigs AUH generates to build several machines in one invocation
+MULTICONFIG_PREFIX = 'auh-'
+
+FAILED_TASK = re.compile("^ERROR: Task \((?:mc:(?P<mc>[^:]*):)?(?P<fn>.*):(?P<task>do_[^)]*)\) failed")
+
+# failures that may go away by themselves, network and mirror issues
+TRANSIENT_ERROR = re.compile(
+        r"Connection (?:reset|refused|timed out)|Operation timed out"
+        r"|Temporary failure in name resolution|Could not resolve host"
+        r"|Network is unreachable|The remote end hung up unexpectedly"
+        r"|early EOF|RPC failed|TLS connection was non-properly terminated"
+        r"|gnutls_handshake|\b50[0234] (?:Internal Server Error|Bad Gateway"
+        r"|Service Unavailable|Gateway Time-?out)|error: 50[0234]\b",
+        re.IGNORECASE)
+
 def get_build_dir():
     return os.getenv('BUILDDIR')
 
+def split_machine(machine):
+    """ Machines may carry the C library to build with, e.g. qemux86_musl """
+    if "_" in machine:
+        return machine.split("_")
+    return machine, None
+
+def multiconfig_name(machine):
+    return MULTICONFIG_PREFIX + machine.replace("_", "-")
+
+def recipe_name(fn):
+    """ Guesses the recipe name from its file, e.g.
+        virtual:native:/path/foo_1.0.bb -> foo """
+    name = os.path.basename(fn.split(':')[-1])
+    if name.endswith(".bb"):
+        name = name[:-3]
+    return name.split('_')[0]
+
+def pf_recipe_name(pf):
+    """ Returns the recipe name of PF, PF is PN-PV-PR """
+    return pf.rsplit('-', 2)[0]
+
+def transient_failure(*outputs):
+    """ Whether the output of a failed command tells it may work if
+        tried again later """
+    return any(o and TRANSIENT_ERROR.search(o) for o in outputs)
+
+def failed_tasks(lines):
+    """ Returns (multiconfig, recipe file, task) for every task bitbake
+        reported as failed, lines is the output or any iterable of its
+        lines. """
+    if isinstance(lines, str):
+        lines = lines.split("\n")
+    tasks = []
+    for line in lines:
+        m = FAILED_TASK.match(line)
+        if m:
+            tasks.append((m.group('mc'), m.group('fn'), m.group('task')))
+    return tasks
+
 class Bitbake(object):
-    def __init__(self, build_dir):
+    def __init__(self, build_dir, tinfoil=None, lock=None):
         self.build_dir = build_dir
         self.log_dir = None
+        self.tinfoil = tinfoil
+        self.env_cache = None
+        self._tmpdir = None
+        # a build directory has a single bitbake server, commands coming
+        # from several threads have to take turns
+        self.lock = lock if lock is not None else threading.RLock()
         super(Bitbake, self).__init__()
 
-    def _cmd(self, recipe=None, options=None, env_var=None, output_filter=None):
+    def _cmd_env(self):
+        env = dict(os.environ)
+        env['BUILDDIR'] = self.build_dir
+        return env
+
+    def set_env_cache(self, env_cache):
+        self.env_cache = env_cache
+
+    def release_server(self):
+        if self.tinfoil is not None:
+            self.tinfoil.release()
+
+    def _cmd(self, recipe=None, options=None, env_var=None, output_filter=None,
+             operation=None, log_file=None):
         cmd = ""
         if env_var is not None:
             cmd += env_var + " "
@@ -64,18 +149,27 @@ class Bitbake(object):
         if output_filter is not None:
             cmd += ' |  grep ' + output_filter
 
-        os.chdir(self.build_dir)
-
         try:
-            stdout, stderr = bb.process.run(cmd)
+            with self.lock:
+                self.release_server()
+                with tracing.span(("bitbake " + (options or "")).strip(),
+                        "command", cmd=cmd):
+                    stdout, stderr = process.run(cmd, cwd=self.build_dir,
+                            env=self._cmd_env(), operation=operation,
+                            log_file=log_file)
         except bb.process.ExecutionError as e:
             D("%s returned:\n%s" % (cmd, e.__str__()))
 
             if self.log_dir is not None and os.path.exists(self.log_dir):
                 with open(os.path.join(self.log_dir, BITBAKE_ERROR_LOG), "a+") as log:
+                    if log_file is not None:
+                        log.write("'%s' failed, the full output is in %s\n" %
+                                (cmd, log_file))
                     log.write(e.stdout)
 
-            raise Error("\'" + cmd + "\' failed", e.stdout, e.stderr)
+            error = Error("\'" + cmd + "\' failed", e.stdout, e.stderr)
+            error.transient = transient_failure(e.stdout, e.stderr)
+            raise error
 
         return stdout
 
@@ -85,29 +179,127 @@ class Bitbake(object):
     def get_stdout_log(self):
         return os.path.join(self.log_dir, BITBAKE_ERROR_LOG)
 
-    def env(self, recipe=None):
-        stdout = self._cmd(recipe, "-e", output_filter="-v \"^#\"")
+    def env(self, recipe=None, variables=None):
+        """ Returns the environment of recipe (or the global one if recipe
+            is None) as a dict. If variables is given only those are
+            looked up, the ones that aren't set are missing from the dict. """
+        if variables is not None:
+            variables = set(variables)
+            if self.env_cache is not None:
+                variables.update(ENV_CACHE_VARIABLES)
 
-        assignment = re.compile("^([^ \t=]*)=(.*)")
-        bb_env = dict()
-        for line in stdout.split('\n'):
-            m = assignment.match(line)
-            if m:
-                if m.group(1) in bb_env:
-                    continue
+        if self.env_cache is not None:
+            bb_env = self.env_cache.get(recipe, variables)
+            if bb_env is not None:
+                return bb_env
 
-                bb_env[m.group(1)] = m.group(2).strip("\"")
+        bb_env = None
+        if self.tinfoil is not None:
+            # the server may be busy with a command of another thread
+            with self.lock:
+                try:
+                    bb_env = self.tinfoil.env(recipe, variables)
+                except Exception as e:
+                    D(" tinfoil failed to get environment for %s, retrying"\
+                      " with 'bitbake -e': %s" % (recipe, e))
+                    self.release_server()
 
         if not bb_env:
+            bb_env = self._env(recipe, variables)
+
+        if self.env_cache is not None:
+            self.env_cache.put(recipe, bb_env, variables)
+
+        return bb_env
+
+    def machine_env(self, machine, variables=None):
+        """ Returns the global environment as it is when building for
+            machine, always from 'bitbake -e'. """
+        machine, libc = split_machine(machine)
+        env_var = "MACHINE=%s" % machine
+        if libc:
+            env_var += " TCLIBC=%s" % libc
+        return self._env(variables=variables, env_var=env_var)
+
+    def _env(self, recipe=None, variables=None, env_var=None):
+        cmd = "bitbake -e"
+        if env_var is not None:
+            cmd = env_var + " " + cmd
+        if recipe is not None:
+            cmd += " " + recipe
+
+        with self.lock:
+            self.release_server()
+            with tracing.span("bitbake -e", "command", cmd=cmd):
+                bb_env, tail = self._read_env(cmd, variables)
+
+        if not bb_env:
+            stdout = ''.join(tail)
+            D("%s returned:\n%s" % (cmd, stdout))
+            if self.log_dir is not None and os.path.exists(self.log_dir):
+                with open(os.path.join(self.log_dir, BITBAKE_ERROR_LOG), "a+") as log:
+                    log.write(stdout)
             raise EmptyEnvError(stdout)
 
         return bb_env
 
+    def _read_env(self, cmd, variables):
+        D(" Running '%s'" % cmd)
+        proc = subprocess.Popen(cmd, shell=True, cwd=self.build_dir,
+                env=self._cmd_env(),
+                stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                universal_newlines=True, errors='replace')
+
+        # read the output as it comes, the full environment is several MB
+        # and most callers only need a few variables out of it
+        bb_env = dict()
+        tail = collections.deque(maxlen=ENV_OUTPUT_TAIL)
+        pending = set(variables) if variables is not None else None
+        try:
+            for line in proc.stdout:
+                tail.append(line)
+                if line.startswith('#'):
+                    continue
+
+                m = ENV_ASSIGNMENT.match(line)
+                if not m or m.group(1) in bb_env:
+                    continue
+
+                name = m.group(1)
+                if pending is None:
+                    bb_env[name] = m.group(2).strip("\"")
+                elif name in pending:
+                    bb_env[name] = m.group(2).strip("\"")
+                    pending.discard(name)
+                    if not pending:
+                        break
+        finally:
+            if proc.poll() is None:
+                proc.kill()
+            proc.stdout.close()
+            proc.wait()
+
+        return bb_env, tail
+
+    def tmpdir(self):
+        if self._tmpdir is None:
+            self._tmpdir = self.env(variables=['TMPDIR'])['TMPDIR']
+        return self._tmpdir
+
     def fetch(self, recipe):
-        return self._cmd(recipe, "-c fetch")
+        return self._cmd(recipe, "-c fetch", operation="upgrade")
+
+    def fetch_all(self, recipes, postread=None, log_file=None):
+        """ Fetches all recipes in a single invocation, going on after
+            failures. """
+        options = "-k -c fetch"
+        if postread is not None:
+            options += " -R " + postread
+        return self._cmd(' '.join(recipes), options, operation="upgrade",
+                log_file=log_file)
 
     def unpack(self, recipe):
-        return self._cmd(recipe, "-c unpack")
+        return self._cmd(recipe, "-c unpack", operation="upgrade")
 
     def checkpkg(self, recipe):
         if recipe == "universe":
@@ -121,13 +313,44 @@ class Bitbake(object):
     def cleansstate(self, recipe):
         return self._cmd(recipe, "-c cleansstate")
 
-    def complete(self, recipe, machine):
-        if "_" in machine:
-            machine, libc = machine.split("_")
+    def complete(self, recipe, machine, operation="compile", log_file=None):
+        machine, libc = split_machine(machine)
+        if libc:
             env = "MACHINE={} TCLIBC={}".format(machine, libc)
         else:
             env = "MACHINE={}".format(machine)
-        return self._cmd(recipe, env_var=env)
+        return self._cmd(recipe, env_var=env, operation=operation,
+                log_file=log_file)
+
+    def setup_multiconfig(self, machines):
+        """ Writes a multiconfig for every machine, each one with its own
+            TMPDIR. sstate and downloads are shared. """
+        mc_dir = os.path.join(self.build_dir, "conf", "multiconfig")
+        if not os.path.exists(mc_dir):
+            os.makedirs(mc_dir)
+
+        for m in machines:
+            machine, libc = split_machine(m)
+            mc = multiconfig_name(m)
+            with open(os.path.join(mc_dir, mc + ".conf"), "w") as f:
+                f.write("# Generated by the Auto Upgrade Helper\n")
+                f.write("MACHINE = \"%s\"\n" % machine)
+                if libc:
+                    f.write("TCLIBC = \"%s\"\n" % libc)
+                f.write("TMPDIR = \"${TOPDIR}/tmp-%s\"\n" % mc)
+
+        if not "BBMULTICONFIG" in os.environ['BB_ENV_EXTRAWHITE'].split():
+            os.environ['BB_ENV_EXTRAWHITE'] = os.environ['BB_ENV_EXTRAWHITE'] + \
+                " BBMULTICONFIG"
+
+    def complete_multiconfig(self, recipe, machines, log_file=None):
+        """ Builds recipe for all machines in a single invocation, the
+            multiconfigs need to be created by setup_multiconfig() first. """
+        mcs = [multiconfig_name(m) for m in machines]
+        targets = ' '.join("mc:%s:%s" % (mc, recipe) for mc in mcs)
+        env = "BBMULTICONFIG=\"%s\"" % ' '.join(mcs)
+        return self._cmd(targets, "-k", env_var=env, operation="compile",
+                log_file=log_file)
 
     def dependency_graph(self, package_list):
         return self._cmd(package_list, "-g")
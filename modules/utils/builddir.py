@@ -0,0 +1,106 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# vim: set ts=4 sw=4 et:
+#
+# This module implements auxiliary build directories. They use the same
+# configuration and layers as the main build directory, share its downloads
+# and sstate, and have their own TMPDIR, devtool workspace and bitbake
+# server, so commands can run in them while the main one is busy.
+#
+
+import os
+import re
+import threading
+import logging as log
+from logging import debug as D
+
+from utils.bitbake import *
+from utils.devtool import Devtool
+from utils.git import Git
+
+class WorkerBuildDir(object):
+    def __init__(self, main_build_dir, build_dir, base_env, git=None):
+        """ If git is given, the worker gets its own worktree of that
+            repository and its layers are used from there. """
+        self.main_build_dir = main_build_dir
+        self.build_dir = build_dir
+        self.layer_dirs = {}
+        self.git = None
+
+        if not os.path.exists(self.build_dir):
+            os.makedirs(self.build_dir)
+
+        if git is not None:
+            worktree_dir = os.path.join(self.build_dir, "worktree")
+            git.worktree_prune()
+            if not os.path.exists(worktree_dir):
+                git.worktree_add(worktree_dir, "HEAD")
+            # the worktree is one of the whole repository, the layers and
+            # git.repo_dir may be anywhere in it
+            toplevel = os.path.realpath(git.toplevel())
+            self.git = Git(self._in_worktree(git.repo_dir, toplevel,
+                    worktree_dir))
+            for layer_dir in base_env['BBLAYERS'].split():
+                new_dir = self._in_worktree(layer_dir, toplevel, worktree_dir)
+                if new_dir is not None:
+                    self.layer_dirs[layer_dir.rstrip("/")] = new_dir
+
+        self._write_conf(base_env)
+
+        self.lock = threading.RLock()
+        self.bb = Bitbake(self.build_dir, lock=self.lock)
+        self.devtool = Devtool(basepath=self.build_dir, lock=self.lock)
+
+        super(WorkerBuildDir, self).__init__()
+
+    def _in_worktree(self, path, toplevel, worktree_dir):
+        """ Returns where path is in worktree_dir, a worktree of the
+            repository in toplevel, or None if path isn't in it """
+        rel = os.path.relpath(os.path.realpath(path), toplevel)
+        if rel == os.pardir or rel.startswith(os.pardir + os.sep):
+            return None
+        return os.path.normpath(os.path.join(worktree_dir, rel))
+
+    def _write_conf(self, base_env):
+        conf_dir = os.path.join(self.build_dir, "conf")
+        if not os.path.exists(conf_dir):
+            os.makedirs(conf_dir)
+
+        main_conf_dir = os.path.join(self.main_build_dir, "conf")
+        with open(os.path.join(conf_dir, "local.conf"), "w") as f:
+            f.write("# Generated by the Auto Upgrade Helper\n")
+            f.write("require %s\n" % os.path.join(main_conf_dir, "local.conf"))
+            # bitbake.conf only looks for these in this build directory
+            f.write("include %s\n" % os.path.join(main_conf_dir, "site.conf"))
+            f.write("include %s\n" % os.path.join(main_conf_dir, "auto.conf"))
+            f.write("DL_DIR = \"%s\"\n" % base_env['DL_DIR'])
+            f.write("SSTATE_DIR = \"%s\"\n" % base_env['SSTATE_DIR'])
+            f.write("TMPDIR = \"${TOPDIR}/tmp\"\n")
+
+        with open(os.path.join(main_conf_dir, "bblayers.conf")) as f:
+            bblayers = f.read()
+
+        bblayers = bblayers.replace("${TOPDIR}", self.main_build_dir)
+        # the devtool workspace of the main build directory is not ours
+        bblayers = bblayers.replace(
+                os.path.join(self.main_build_dir, "workspace"), "")
+        if self.layer_dirs:
+            # in one pass, a layer may be in the directory of another one
+            layers_re = "|".join(re.escape(l) for l in sorted(self.layer_dirs,
+                    key=len, reverse=True))
+            bblayers = re.sub(r'(%s)(?=[/\s"\'\\]|$)' % layers_re,
+                    lambda m: self.layer_dirs[m.group(1)], bblayers,
+                    flags=re.M)
+
+        # devtool adds the workspace layer of this build directory back
+        # when it runs
+        with open(os.path.join(conf_dir, "bblayers.conf"), "w") as f:
+            f.write(bblayers)
+
+        D(" Worker build directory ready in %s" % self.build_dir)
+
+    def reset_worktree(self, commit):
+        """ Drops whatever a previous upgrade left in the worktree and
+            moves it to commit. """
+        self.git.reset_hard()
+        self.git.clean_untracked()
+        self.git.checkout_detached(commit)
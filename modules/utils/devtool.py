@@ -1,33 +1,48 @@
 # SPDX-License-Identifier: GPL-2.0-or-later
 import os
+import threading
 import logging as log
 from logging import debug as D
 
 from utils.bitbake import *
 
 class Devtool(object):
-    def __init__(self):
+    def __init__(self, tinfoil=None, basepath=None, lock=None):
+        self.tinfoil = tinfoil
+        self.basepath = basepath
+        self.lock = lock if lock is not None else threading.RLock()
         super(Devtool, self).__init__()
 
-    def _cmd(self, operation):
-        cmd = "devtool " + operation
+    def _cmd(self, operation, log_file=None):
+        if self.basepath is not None:
+            cmd = "devtool --basepath " + self.basepath + " " + operation
+        else:
+            cmd = "devtool " + operation
         try:
             D("Running '%s'" %(cmd))
-            stdout, stderr = bb.process.run(cmd)
+            with self.lock:
+                if self.tinfoil is not None:
+                    self.tinfoil.release()
+                with tracing.span("devtool " + operation.split()[0],
+                        "command", cmd=cmd):
+                    stdout, stderr = process.run(cmd, cwd=self.basepath,
+                            operation="upgrade", log_file=log_file)
         except bb.process.ExecutionError as e:
             D("%s returned:\n%s" % (cmd, e.__str__()))
-            raise DevtoolError("The following devtool command failed: " + operation,
+            error = DevtoolError("The following devtool command failed: " + operation,
                         e.stdout, e.stderr)
+            error.transient = transient_failure(e.stdout, e.stderr)
+            raise error
 
         return stdout
 
-    def upgrade(self, recipe, version = None, revision = None):
+    def upgrade(self, recipe, version = None, revision = None, log_file = None):
         cmd = " upgrade " + recipe
         if version and not version.endswith("-new-commits-available"):
             cmd = cmd + " -V " + version
         if revision and revision != "N/A":
             cmd = cmd + " -S " + revision
-        return self._cmd(cmd)
+        return self._cmd(cmd, log_file)
 
     def finish(self, recipe, layer):
         cmd = " finish -f " + recipe + " " + layer
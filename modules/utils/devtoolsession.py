@@ -0,0 +1,176 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# vim: set ts=4 sw=4 et:
+#
+# This module runs devtool commands in the AUH process instead of spawning
+# a 'devtool' for each of them. devtool and its plugins are loaded once, the
+# tinfoil the plugins ask for through setup_tinfoil() is the one of the AUH
+# tinfoil session, so 'devtool upgrade' and 'devtool finish' don't parse the
+# metadata again. What devtool logs is captured with the bitbake formatter,
+# the output reads like the one of the command line tool.
+#
+# Commands fall back to the command line tool when the session can't be set
+# up, when it breaks (it isn't used anymore then) and when devtool commands
+# have a timeout, a command running in the AUH process can't be killed.
+#
+
+import io
+import os
+import sys
+import shlex
+import shutil
+import logging
+import traceback
+import contextlib
+import importlib.util
+import importlib.machinery
+from logging import debug as D
+from logging import warning as W
+
+from utils.devtool import Devtool
+from utils.bitbake import *
+
+# loggers whose records are part of the output of a command
+CAPTURED_LOGGERS = ('devtool', 'BitBake')
+
+class SessionError(Exception):
+    pass
+
+class _SharedTinfoil(object):
+    """ The tinfoil handed out to devtool plugins, they shut it down when
+        they are done but it is kept for the next command. """
+    def __init__(self, tinfoil):
+        self._tinfoil = tinfoil
+
+    def __getattr__(self, name):
+        return getattr(self._tinfoil, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        pass
+
+    def shutdown(self):
+        pass
+
+class DevtoolSession(Devtool):
+    def __init__(self, tinfoil, lock=None):
+        self.cli = None
+        self.disabled = False
+
+        super(DevtoolSession, self).__init__(tinfoil, lock=lock)
+
+    def _load(self):
+        """ Loads the devtool script as a module, it loads the plugins the
+            first time a command runs. """
+        script = shutil.which("devtool")
+        if script is None:
+            raise SessionError("devtool isn't in PATH")
+
+        loader = importlib.machinery.SourceFileLoader("auh_devtool",
+                os.path.realpath(script))
+        spec = importlib.util.spec_from_loader(loader.name, loader)
+        cli = importlib.util.module_from_spec(spec)
+        loader.exec_module(cli)
+        return cli
+
+    def _setup_tinfoil(self, config_only=False, basepath=None, tracking=False):
+        tinfoil = self.tinfoil.get()
+        if tinfoil is None:
+            raise SessionError("no tinfoil session")
+        if tracking and not self.tinfoil.tracking:
+            raise SessionError("the tinfoil session doesn't track variables")
+        return _SharedTinfoil(tinfoil)
+
+    def _patch(self):
+        # the plugins import setup_tinfoil from the devtool package, the
+        # ones that are loaded already have their own reference to it
+        import devtool
+        for module in [devtool, self.cli] + list(getattr(self.cli, 'plugins', [])):
+            if hasattr(module, 'setup_tinfoil'):
+                module.setup_tinfoil = self._setup_tinfoil
+
+    @contextlib.contextmanager
+    def _capture(self, stream):
+        import bb.msg
+        handler = logging.StreamHandler(stream)
+        handler.setFormatter(bb.msg.BBLogFormatter("%(levelname)s: %(message)s"))
+
+        saved = []
+        for name in CAPTURED_LOGGERS:
+            logger = logging.getLogger(name)
+            saved.append((logger, logger.handlers, logger.propagate))
+            logger.handlers = [handler]
+            logger.propagate = False
+        try:
+            with contextlib.redirect_stdout(stream), \
+                    contextlib.redirect_stderr(stream):
+                yield
+        finally:
+            for logger, handlers, propagate in saved:
+                logger.handlers = handlers
+                logger.propagate = propagate
+            handler.flush()
+
+    def _run(self, operation, stream):
+        """ Runs devtool's main() for operation, returns its exit code """
+        if self.cli is None:
+            self.cli = self._load()
+        self._patch()
+
+        tinfoil = self.tinfoil.get()
+        if tinfoil is None:
+            raise SessionError("no tinfoil session")
+        # the previous commands changed the workspace and the recipes
+        if hasattr(tinfoil, 'modified_files'):
+            tinfoil.modified_files()
+
+        argv = sys.argv
+        sys.argv = ["devtool"] + shlex.split(operation)
+        try:
+            with self._capture(stream):
+                ret = self.cli.main()
+        except SystemExit as e:
+            ret = e.code
+        finally:
+            sys.argv = argv
+
+        if ret is None:
+            return 0
+        if not isinstance(ret, int):
+            stream.write("%s\n" % ret)
+            return 1
+        return ret
+
+    def _cmd(self, operation, log_file=None):
+        if self.disabled or process.get_timeout("upgrade") is not None:
+            return super(DevtoolSession, self)._cmd(operation, log_file)
+
+        D("Running 'devtool %s' in the devtool session" % operation.strip())
+        try:
+            with self.lock:
+                with tracing.span("devtool " + operation.split()[0],
+                        "command", cmd="devtool" + operation, session=True):
+                    if log_file is not None:
+                        with open(log_file, 'w') as stream:
+                            ret = self._run(operation, stream)
+                        output = process.read_tail(log_file)
+                    else:
+                        stream = io.StringIO()
+                        ret = self._run(operation, stream)
+                        output = stream.getvalue()
+        except Exception as e:
+            W(" The devtool session failed, using the devtool command from"\
+              " now on: %s" % e)
+            D(traceback.format_exc())
+            self.disabled = True
+            return super(DevtoolSession, self)._cmd(operation, log_file)
+
+        if ret != 0:
+            D("'devtool%s' returned %s:\n%s" % (operation, ret, output))
+            error = DevtoolError("The following devtool command failed: " + operation,
+                        output, None)
+            error.transient = transient_failure(output)
+            raise error
+
+        return output
@@ -0,0 +1,188 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# vim: set ts=4 sw=4 et:
+#
+# This module implements an on-disk cache for the environments returned by
+# Bitbake.env(). Entries are validated against the content of every file
+# bitbake read to produce them (recipe, bbappends, .inc files, configuration
+# files) so they are only reused while none of those changed.
+#
+
+import os
+import glob
+import json
+import hashlib
+import tempfile
+import logging as log
+from logging import debug as D
+from logging import warning as W
+
+ENV_CACHE_VERSION = 3
+
+BASE_ENV_NAME = "__base__"
+
+# variables that need to be part of a cached environment in order to
+# validate it later
+ENV_CACHE_VARIABLES = ('FILE', 'BBINCLUDED', 'BBFILES')
+
+# configuration files that always affect the environment, even if bitbake
+# doesn't report them in BBINCLUDED
+CONF_FILES = ['conf/local.conf', 'conf/bblayers.conf', 'conf/auto.conf',
+              'conf/site.conf']
+
+class EnvCache(object):
+    def __init__(self, cache_dir, build_dir, rebuild=False):
+        self.cache_dir = cache_dir
+        self.rebuild = rebuild
+        self.conf_files = [os.path.join(build_dir, f) for f in CONF_FILES]
+        self._hashes = dict()
+        self._written = set()
+
+        if not os.path.exists(self.cache_dir):
+            os.makedirs(self.cache_dir)
+
+        super(EnvCache, self).__init__()
+
+    def _entry_path(self, recipe):
+        return os.path.join(self.cache_dir,
+                "%s.json" % (recipe if recipe else BASE_ENV_NAME))
+
+    def _file_hash(self, path):
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+
+        memo = self._hashes.get(path)
+        if memo and memo[0] == st.st_mtime_ns and memo[1] == st.st_size:
+            return memo[2]
+
+        h = hashlib.sha256()
+        try:
+            with open(path, 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), b''):
+                    h.update(chunk)
+        except OSError:
+            return None
+
+        self._hashes[path] = (st.st_mtime_ns, st.st_size, h.hexdigest())
+        return h.hexdigest()
+
+    def _env_key(self):
+        # variables passed through from the shell change the environment too
+        names = set(['MACHINE', 'DISTRO', 'TCLIBC'])
+        for whitelist in ('BB_ENV_EXTRAWHITE', 'BB_ENV_PASSTHROUGH_ADDITIONS'):
+            names.update(os.getenv(whitelist, '').split())
+
+        h = hashlib.sha256()
+        for name in sorted(names):
+            h.update(("%s=%s\n" % (name, os.getenv(name, ''))).encode('utf-8'))
+        return h.hexdigest()
+
+    def _appends_hash(self, bbfiles):
+        # a new bbappend is not part of the files recorded for the entry,
+        # so fingerprint all bbappends the layers provide, their names and
+        # their contents, an edited bbappend changes the environment too
+        appends = set()
+        for pattern in bbfiles:
+            if pattern.endswith('.bbappend'):
+                appends.update(glob.glob(pattern))
+
+        h = hashlib.sha256()
+        for append in sorted(appends):
+            h.update(("%s %s\n" % (append, self._file_hash(append))
+                    ).encode('utf-8'))
+        return h.hexdigest()
+
+    def _deps(self, bb_env):
+        deps = set(self.conf_files)
+        deps.update(bb_env.get('BBINCLUDED', '').split())
+        if 'FILE' in bb_env:
+            deps.add(bb_env['FILE'])
+        return sorted(deps)
+
+    def _load(self, recipe):
+        entry_path = self._entry_path(recipe)
+        if not os.path.exists(entry_path):
+            return None
+
+        # when rebuilding only trust what was stored during this run
+        if self.rebuild and recipe not in self._written:
+            return None
+
+        try:
+            with open(entry_path) as f:
+                entry = json.load(f)
+        except (OSError, ValueError) as e:
+            W(" Ignoring broken environment cache entry %s: %s" % (entry_path, e))
+            return None
+
+        if entry.get('version') != ENV_CACHE_VERSION or \
+                entry.get('env_key') != self._env_key():
+            return None
+
+        for path, digest in entry['deps'].items():
+            if self._file_hash(path) != digest:
+                D(" Environment cache for %s invalidated by %s" %
+                        (recipe or BASE_ENV_NAME, path))
+                return None
+
+        if entry['appends'] != self._appends_hash(entry['bbfiles']):
+            D(" Environment cache for %s invalidated by bbappends" %
+                    (recipe or BASE_ENV_NAME))
+            return None
+
+        return entry
+
+    def get(self, recipe=None, variables=None):
+        entry = self._load(recipe)
+        if entry is None:
+            return None
+
+        bb_env = entry['env']
+        if variables is None:
+            if not entry['complete']:
+                return None
+        else:
+            if not entry['complete'] and \
+                    not set(variables).issubset(entry['queried']):
+                return None
+            bb_env = dict((v, bb_env[v]) for v in variables if v in bb_env)
+
+        D(" Environment for %s loaded from cache" % (recipe or BASE_ENV_NAME))
+        return bb_env
+
+    def put(self, recipe, bb_env, variables=None):
+        bbfiles = bb_env.get('BBFILES', '').split()
+
+        entry = dict()
+        entry['version'] = ENV_CACHE_VERSION
+        entry['env_key'] = self._env_key()
+        entry['deps'] = dict((path, self._file_hash(path))
+                for path in self._deps(bb_env))
+        entry['bbfiles'] = bbfiles
+        entry['appends'] = self._appends_hash(bbfiles)
+        entry['complete'] = variables is None
+        entry['queried'] = sorted(variables) if variables is not None else []
+        entry['env'] = bb_env
+
+        if variables is not None:
+            # keep what previous partial lookups already stored
+            old_entry = self._load(recipe)
+            if old_entry is not None and not old_entry['complete'] and \
+                    old_entry['deps'] == entry['deps']:
+                env = dict(old_entry['env'])
+                env.update(bb_env)
+                entry['env'] = env
+                entry['queried'] = sorted(set(old_entry['queried']) | set(variables))
+
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump(entry, f)
+            os.replace(tmp_path, self._entry_path(recipe))
+            self._written.add(recipe)
+        except OSError as e:
+            W(" Unable to store environment cache entry for %s: %s" %
+                    (recipe or BASE_ENV_NAME, e))
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
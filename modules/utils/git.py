@@ -35,11 +35,12 @@ class Git(object):
         super(Git, self).__init__()
 
     def _cmd(self, operation):
-        os.chdir(self.repo_dir)
-
         cmd = "git " + operation
         try:
-            stdout, stderr = bb.process.run(cmd)
+            with tracing.span("git " + operation.split()[0], "command",
+                    cmd=cmd):
+                stdout, stderr = process.run(cmd, cwd=self.repo_dir,
+                        operation="git")
         except bb.process.ExecutionError as e:
             D("%s executed from %s returned:\n%s" % (cmd, self.repo_dir, e.__str__()))
             raise Error("The following git command failed: " + operation,
@@ -77,6 +78,24 @@ class Git(object):
     def status(self):
         return self._cmd("status --porcelain")
 
+    def cherry_pick(self, commit):
+        return self._cmd("cherry-pick " + commit)
+
+    def abort_cherry_pick(self):
+        return self._cmd("cherry-pick --abort")
+
+    def toplevel(self):
+        return self._cmd("rev-parse --show-toplevel").strip()
+
+    def worktree_add(self, path, commit):
+        return self._cmd("worktree add --detach " + path + " " + commit)
+
+    def worktree_prune(self):
+        return self._cmd("worktree prune")
+
+    def checkout_detached(self, commit):
+        return self._cmd("checkout --detach " + commit)
+
     def checkout_branch(self, branch_name):
         return self._cmd("checkout " + branch_name)
 
@@ -95,11 +114,20 @@ class Git(object):
         else:
             return self._cmd("reset --hard HEAD~" + str(no_of_patches))
 
+    def reset_path(self, path):
+        """ Drops the changes to the files of path, staged or not. Files
+            that aren't in HEAD are left, see clean_untracked(). """
+        self._cmd("reset -q HEAD -- " + path)
+        return self._cmd("checkout HEAD -- " + path)
+
     def reset_soft(self, no_of_patches):
         return self._cmd("reset --soft HEAD~" + str(no_of_patches))
 
-    def clean_untracked(self):
-        return self._cmd("clean -fd")
+    def clean_untracked(self, path=None):
+        if path is None:
+            return self._cmd("clean -fd")
+        else:
+            return self._cmd("clean -fd " + path)
 
     def last_commit(self, branch_name):
         return self._cmd("log --pretty=format:\"%H\" -1 " + branch_name)
@@ -0,0 +1,143 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# vim: set ts=4 sw=4 et:
+#
+# This module runs the commands AUH spawns (bitbake, devtool, git) with an
+# optional timeout per kind of operation. A command that times out is killed
+# along with everything it started and CommandTimeoutError is raised.
+#
+
+import os
+import signal
+import threading
+import subprocess
+import logging as log
+from logging import debug as D
+
+import bb.process
+
+from errors import *
+
+# kinds of operations a timeout can be set for
+OPERATIONS = ('upgrade', 'compile', 'testimage', 'git')
+
+# seconds a command has to exit after SIGTERM, before SIGKILL
+KILL_GRACE_PERIOD = 30
+
+# how much of a log file is kept in memory, in lines and at most in bytes
+OUTPUT_TAIL_LINES = 200
+OUTPUT_TAIL_BYTES = 64 * 1024
+
+# operation -> timeout in seconds, operations that aren't set have none
+_timeouts = dict()
+
+# commands running in a session of their own, see kill_all()
+_running = set()
+_running_lock = threading.Lock()
+
+def set_timeout(operation, seconds):
+    if seconds:
+        _timeouts[operation] = seconds
+    else:
+        _timeouts.pop(operation, None)
+
+def get_timeout(operation):
+    """ Returns the timeout of operation in seconds, or None """
+    return _timeouts.get(operation)
+
+def _kill(proc):
+    """ Kills the process group of proc, politely first """
+    for sig in (signal.SIGTERM, signal.SIGKILL):
+        try:
+            os.killpg(proc.pid, sig)
+        except ProcessLookupError:
+            pass
+
+        try:
+            return proc.communicate(timeout=KILL_GRACE_PERIOD)
+        except subprocess.TimeoutExpired:
+            D(" '%s' didn't exit after signal %d" % (proc.args, sig))
+    return proc.communicate()
+
+def kill_all():
+    """ Kills the commands that aren't in our process group """
+    with _running_lock:
+        for proc in _running:
+            try:
+                os.killpg(proc.pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+
+def read_tail(log_file, lines=OUTPUT_TAIL_LINES):
+    """ Returns the last lines of log_file, reading OUTPUT_TAIL_BYTES at
+        most whatever its size """
+    with open(log_file, 'rb') as f:
+        f.seek(0, os.SEEK_END)
+        size = f.tell()
+        f.seek(max(0, size - OUTPUT_TAIL_BYTES))
+        data = f.read()
+
+    if size > OUTPUT_TAIL_BYTES:
+        # the first line is cut
+        data = data.partition(b"\n")[2]
+    tail = data.decode('utf-8', errors='replace').split("\n")
+    if len(tail) > lines + 1:
+        tail = tail[-lines - 1:]
+    return "\n".join(tail)
+
+def _run_logged(cmd, cwd, env, timeout, log_file):
+    # stdout and stderr are written by the command itself, they are never
+    # in memory
+    with open(log_file, 'w') as log:
+        proc = subprocess.Popen(cmd, shell=True, cwd=cwd, env=env,
+                stdin=subprocess.DEVNULL, stdout=log, stderr=subprocess.STDOUT,
+                start_new_session=timeout is not None)
+
+    if timeout is not None:
+        with _running_lock:
+            _running.add(proc)
+    try:
+        proc.wait(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        _kill(proc)
+        raise CommandTimeoutError(cmd, timeout, read_tail(log_file))
+    finally:
+        with _running_lock:
+            _running.discard(proc)
+
+    if proc.returncode != 0:
+        raise bb.process.ExecutionError(cmd, proc.returncode,
+                read_tail(log_file), None)
+    return read_tail(log_file), ""
+
+def run(cmd, cwd=None, env=None, operation=None, log_file=None):
+    """ Runs cmd like bb.process.run(), returns (stdout, stderr). Raises
+        CommandTimeoutError if it takes longer than the timeout of
+        operation. If log_file is given, the output (stdout and stderr
+        together) goes to log_file and only its tail is returned, or is the
+        stdout of the error raised. """
+    timeout = _timeouts.get(operation)
+    if log_file is not None:
+        return _run_logged(cmd, cwd, env, timeout, log_file)
+
+    if timeout is None:
+        return bb.process.run(cmd, cwd=cwd, env=env)
+
+    # a session of its own, so the whole tree can be killed
+    proc = subprocess.Popen(cmd, shell=True, cwd=cwd, env=env,
+            stdout=subprocess.PIPE, stderr=subprocess.PIPE,
+            universal_newlines=True, errors='replace',
+            start_new_session=True)
+    with _running_lock:
+        _running.add(proc)
+    try:
+        stdout, stderr = proc.communicate(timeout=timeout)
+    except subprocess.TimeoutExpired:
+        stdout, stderr = _kill(proc)
+        raise CommandTimeoutError(cmd, timeout, stdout, stderr)
+    finally:
+        with _running_lock:
+            _running.discard(proc)
+
+    if proc.returncode != 0:
+        raise bb.process.ExecutionError(cmd, proc.returncode, stdout, stderr)
+    return stdout, stderr
@@ -0,0 +1,196 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# vim: set ts=4 sw=4 et:
+#
+# This module implements an on-disk index of the recipes bitbake sees, with
+# the layer, file, version and maintainer of every version of each one. It
+# is rebuilt as a whole when the configuration, the list of layers or the
+# git HEAD (or local changes) of a layer changed, otherwise no parsing is
+# needed to use it.
+#
+
+import os
+import json
+import hashlib
+import tempfile
+import logging as log
+from logging import debug as D
+from logging import info as I
+from logging import warning as W
+
+from errors import *
+from utils.git import Git
+
+RECIPE_INDEX_VERSION = 2
+
+class RecipeIndex(object):
+    def __init__(self, index_file, bblayers, conf_files):
+        self.index_file = index_file
+        self.layer_dirs = bblayers.split()
+        self.conf_files = conf_files
+        self.state = self._state()
+        self.entries = self._load()
+
+        super(RecipeIndex, self).__init__()
+
+    def _layer_state(self, layer_dir):
+        """ Returns None for layers that aren't in git, the index is
+            rebuilt every time then. """
+        if not os.path.isdir(layer_dir):
+            return None
+
+        git = Git(layer_dir)
+        try:
+            head = git.last_commit("HEAD")
+            status = git.status()
+        except Error:
+            return None
+
+        return "%s %s" % (head,
+                hashlib.sha256(status.encode('utf-8')).hexdigest())
+
+    def _state(self):
+        h = hashlib.sha256()
+        for conf in self.conf_files:
+            if os.path.exists(conf):
+                with open(conf, 'rb') as f:
+                    h.update(f.read())
+
+        layers = dict()
+        for layer_dir in self.layer_dirs:
+            layers[layer_dir] = self._layer_state(layer_dir)
+
+        return {'conf': h.hexdigest(), 'layers': layers}
+
+    def _load(self):
+        if not os.path.exists(self.index_file):
+            return None
+
+        try:
+            with open(self.index_file) as f:
+                index = json.load(f)
+        except (OSError, ValueError) as e:
+            W(" Ignoring recipe index %s: %s" % (self.index_file, e))
+            return None
+
+        if index.get('version') != RECIPE_INDEX_VERSION:
+            return None
+
+        if index['state']['conf'] != self.state['conf']:
+            D(" Recipe index: configuration changed")
+            return None
+        for layer_dir, state in self.state['layers'].items():
+            if state is None or index['state']['layers'].get(layer_dir) != state:
+                D(" Recipe index: %s changed" % layer_dir)
+                return None
+        if len(index['state']['layers']) != len(self.state['layers']):
+            D(" Recipe index: layers changed")
+            return None
+
+        return index['recipes']
+
+    def _save(self):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.index_file),
+                suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump({'version': RECIPE_INDEX_VERSION, 'state': self.state,
+                       'recipes': self.entries}, f)
+        os.replace(tmp, self.index_file)
+
+    def _layer_dir(self, fn):
+        found = None
+        for layer_dir in self.layer_dirs:
+            if fn.startswith(layer_dir.rstrip("/") + "/") and \
+                    (found is None or len(layer_dir) > len(found)):
+                found = layer_dir
+        return found
+
+    def _maintainer(self, d, pn):
+        # maintainers are assigned per recipe in the configuration
+        for var in ('RECIPE_MAINTAINER:pn-%s', 'RECIPE_MAINTAINER_pn-%s'):
+            maintainer = d.getVar(var % pn)
+            if maintainer:
+                return maintainer
+        return None
+
+    def _entry(self, d, fn, pv, maintainer, skipped, preferred):
+        import bb.utils
+
+        # virtual:native:/path/foo_1.0.bb
+        fn = fn.split(':')[-1]
+        return {'layer': bb.utils.get_file_layer(fn, d),
+                'layer_dir': self._layer_dir(fn), 'file': fn, 'pv': pv,
+                'maintainer': maintainer, 'skipped': skipped,
+                'preferred': preferred}
+
+    def _build(self, tinfoil):
+        I(" Indexing recipes ...")
+        d = tinfoil.config_data
+
+        # (latest versions, preferred versions, required versions), the
+        # preferred one is (version, file) per recipe
+        preferred_versions = tinfoil.find_providers()[1]
+
+        # every version of every recipe, as 'bitbake-layers show-recipes'
+        # lists them
+        entries = dict()
+        recipecache = tinfoil.cooker_data
+        for pn, fns in recipecache.pkg_pn.items():
+            preferred = preferred_versions.get(pn, (None, None))[1]
+            maintainer = self._maintainer(d, pn)
+            for fn in fns:
+                entries.setdefault(pn, []).append(self._entry(d, fn,
+                        recipecache.pkg_pepvpr[fn][1], maintainer, False,
+                        fn == preferred))
+
+        # skipped recipes aren't parsed completely, guess their version
+        # from the file name as bitbake-layers does
+        for fn, skipped in tinfoil.cooker.skiplist.items():
+            fn = fn.split(':')[-1]
+            parts = os.path.splitext(os.path.basename(fn))[0].split('_')
+            pn = getattr(skipped, 'pn', None) or parts[0]
+            if fn in (e['file'] for e in entries.get(pn, [])):
+                continue
+            entries.setdefault(pn, []).append(self._entry(d, fn,
+                    parts[1] if len(parts) > 1 else None,
+                    self._maintainer(d, pn), True, False))
+
+        self.entries = entries
+        self._save()
+        D(" Recipe index: %d recipes" % len(entries))
+
+    def update(self, tinfoil):
+        """ Rebuilds the whole index from tinfoil (a TinfoilSession) if
+            the configuration or any layer changed. A change in one layer
+            can change the preferred versions and the appends of recipes in
+            the others, they are all parsed again. """
+        if self.entries is not None:
+            return
+
+        t = tinfoil.get()
+        if t is None:
+            raise Error("Can't parse the recipes to index them")
+        self._build(t)
+
+    def _in_layer(self, entry, layer_name):
+        # layer_name is the layer directory name, as bitbake-layers prints
+        # it, or its collection name
+        return layer_name in (entry['layer'], os.path.basename(
+                (entry['layer_dir'] or "").rstrip("/")))
+
+    def recipes(self, layer_name):
+        """ Returns the recipes with a version in layer_name that isn't
+            skipped. """
+        return sorted(pn for pn, entries in self.entries.items()
+                if any(self._in_layer(e, layer_name) and not e['skipped']
+                    for e in entries))
+
+    def get(self, pn):
+        """ Returns the entry of the preferred version of pn, or of its
+            first version if none is preferred """
+        entries = self.entries.get(pn)
+        if not entries:
+            return None
+        for e in entries:
+            if e['preferred']:
+                return e
+        return entries[0]
@@ -0,0 +1,133 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# vim: set ts=4 sw=4 et:
+#
+# This module keeps one tinfoil connection to the bitbake server open so
+# that environment queries are answered from the already parsed metadata
+# instead of spawning a new 'bitbake -e' for every recipe.
+#
+
+import os
+import sys
+import logging as log
+from logging import debug as D
+from logging import warning as W
+
+from utils.bitbake import *
+
+# Time (in seconds) the bitbake server stays resident after the last client
+# disconnects. The session has to give up its connection whenever AUH runs
+# a bitbake/devtool command, keeping the server alive in between lets both
+# reuse the parsed cache.
+DEFAULT_SERVER_TIMEOUT = "600"
+
+# failed connections in a row after which the session isn't used anymore,
+# a failure may only mean that the server was busy
+MAX_CONNECT_FAILURES = 3
+
+def _config_error(e):
+    """ Whether starting tinfoil failed on the configuration, trying
+        again won't help """
+    try:
+        import bb.parse
+        import bb.tinfoil
+    except ImportError:
+        return True
+    return isinstance(e, (bb.parse.ParseError, bb.tinfoil.TinfoilUIException))
+
+class TinfoilSession(object):
+    def __init__(self, build_dir, tracking=False):
+        self.build_dir = build_dir
+        # variable history, devtool needs it to edit recipes
+        self.tracking = tracking
+        self.tinfoil = None
+        self.disabled = False
+        self.failures = 0
+
+        if not os.getenv('BB_SERVER_TIMEOUT'):
+            os.environ['BB_SERVER_TIMEOUT'] = DEFAULT_SERVER_TIMEOUT
+
+        super(TinfoilSession, self).__init__()
+
+    def _prepare(self):
+        import bb.tinfoil
+
+        os.chdir(self.build_dir)
+        tinfoil = bb.tinfoil.Tinfoil(output=sys.stderr, tracking=self.tracking,
+                setup_logging=False)
+        try:
+            tinfoil.prepare(config_only=False, quiet=2)
+        except:
+            tinfoil.shutdown()
+            raise
+
+        return tinfoil
+
+    def get(self):
+        if self.disabled:
+            return None
+
+        if self.tinfoil is None:
+            try:
+                D(" Starting tinfoil session in %s" % self.build_dir)
+                self.tinfoil = self._prepare()
+                self.failures = 0
+            except Exception as e:
+                self.release()
+                self.failures += 1
+                if _config_error(e) or self.failures >= MAX_CONNECT_FAILURES:
+                    W(" Unable to start a tinfoil session, falling back to"\
+                      " 'bitbake -e': %s" % e)
+                    self.disabled = True
+                else:
+                    D(" Unable to start a tinfoil session, trying again"\
+                      " next time: %s" % e)
+                return None
+
+        return self.tinfoil
+
+    def release(self):
+        """ Disconnect from the bitbake server, only one client can be
+            active at a time so this needs to be done before running
+            any other bitbake command. """
+        if self.tinfoil is not None:
+            try:
+                self.tinfoil.shutdown()
+            except Exception as e:
+                D(" tinfoil shutdown failed: %s" % e)
+            self.tinfoil = None
+
+    def close(self):
+        self.release()
+        self.disabled = True
+
+    def env(self, recipe=None, variables=None):
+        tinfoil = self.get()
+        if tinfoil is None:
+            return None
+
+        if recipe is None:
+            d = tinfoil.config_data
+        else:
+            d = tinfoil.parse_recipe(recipe)
+
+        bb_env = dict()
+        if variables is not None:
+            for var in variables:
+                value = d.getVar(var)
+                if value is not None:
+                    bb_env[var] = str(value)
+            return bb_env
+
+        for var in d.keys():
+            # internal variables and functions aren't printed by 'bitbake -e'
+            # as assignments either
+            if var.startswith('__') or d.getVarFlag(var, 'func', False):
+                continue
+
+            value = d.getVar(var)
+            if value is None:
+                continue
+
+            bb_env[var] = str(value)
+
+        return bb_env
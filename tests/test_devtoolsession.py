@@ -0,0 +1,132 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# vim: set ts=4 sw=4 et:
+#
+# 'devtool upgrade' run in the devtool session has to fail the way the
+# devtool command does, steps.devtool_upgrade parses the same output. A
+# small devtool script stands for the real one, it is run both ways. Needs
+# the bitbake libraries, run from a build environment:
+#   python3 -m unittest discover -s tests
+#
+
+import os
+import sys
+import shutil
+import tempfile
+import unittest
+
+sys.path.insert(1, os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'modules'))
+
+from errors import *
+from context import RecipeContext
+from utils.devtool import Devtool
+from utils.devtoolsession import DevtoolSession
+import steps
+
+DEVTOOL_PACKAGE = """
+class DevtoolError(Exception):
+    pass
+
+class Tinfoil(object):
+    def shutdown(self):
+        pass
+
+def setup_tinfoil(config_only=False, basepath=None, tracking=False):
+    return Tinfoil()
+"""
+
+DEVTOOL_SCRIPT = """#!/usr/bin/env python3
+import os
+import sys
+import logging
+sys.path = sys.path + [os.path.join(os.path.dirname(
+    os.path.realpath(__file__)), 'lib')]
+from devtool import DevtoolError, setup_tinfoil
+
+logger = logging.getLogger('devtool')
+handler = logging.StreamHandler()
+handler.setFormatter(logging.Formatter("%(levelname)s: %(message)s"))
+logger.addHandler(handler)
+plugins = []
+
+def main():
+    import devtool
+    args = sys.argv[1:]
+    if args[0] != 'upgrade':
+        return 0
+
+    tinfoil = devtool.setup_tinfoil(tracking=True)
+    tinfoil.shutdown()
+    if args[1] == 'conflict':
+        logger.warning("Command 'git rebase' failed:\\n"
+                "CONFLICT (content): Merge conflict in main.c")
+        return 0
+    logger.error("Fetcher failure for URL: 'https://example.com/error.tar.gz'")
+    print("Connection refused")
+    return 1
+
+if __name__ == "__main__":
+    sys.exit(main())
+"""
+
+class FakeTinfoilSession(object):
+    tracking = True
+
+    def get(self):
+        return object()
+
+    def release(self):
+        pass
+
+class TestDevtoolSession(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        os.makedirs(os.path.join(self.dir, "lib", "devtool"))
+        with open(os.path.join(self.dir, "lib", "devtool", "__init__.py"),
+                "w") as f:
+            f.write(DEVTOOL_PACKAGE)
+        script = os.path.join(self.dir, "devtool")
+        with open(script, "w") as f:
+            f.write(DEVTOOL_SCRIPT)
+        os.chmod(script, 0o755)
+
+        self.path = os.environ['PATH']
+        os.environ['PATH'] = self.dir + ":" + self.path
+
+    def tearDown(self):
+        os.environ['PATH'] = self.path
+        shutil.rmtree(self.dir)
+
+    def _upgrade(self, devtool, pn):
+        base_dir = tempfile.mkdtemp(dir=self.dir)
+        pkg_ctx = RecipeContext(pn, "1.0", "2.0", None, "N/A", base_dir)
+        pkg_ctx.workdir = os.path.join(base_dir, pn)
+        os.mkdir(pkg_ctx.workdir)
+        with self.assertRaises(DevtoolError) as cm:
+            steps.devtool_upgrade(devtool, None, None, {}, pkg_ctx)
+        return cm.exception
+
+    def _check(self, pn):
+        session = DevtoolSession(FakeTinfoilSession())
+        error = self._upgrade(session, pn)
+        self.assertFalse(session.disabled)
+        import devtool
+        self.assertEqual(devtool.setup_tinfoil, session._setup_tinfoil)
+
+        cli_error = self._upgrade(Devtool(), pn)
+        self.assertEqual(error.message, cli_error.message)
+        self.assertEqual(error.stdout, cli_error.stdout)
+        self.assertEqual(error.transient, cli_error.transient)
+        return error
+
+    def test_conflict(self):
+        error = self._check("conflict")
+        self.assertIn("Merge conflict", error.stdout)
+
+    def test_error(self):
+        error = self._check("error")
+        self.assertIn("ERROR: Fetcher failure", error.stdout)
+        self.assertTrue(error.transient)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,72 @@
+# SPDX-License-Identifier: GPL-2.0-or-later
+# vim: set ts=4 sw=4 et:
+#
+# Failure fingerprints are compared across runs, they must not depend on
+# the hash seed nor on how machine names overlap. Needs the bitbake
+# libraries, run from a build environment:
+#   python3 -m unittest discover -s tests
+#
+
+import os
+import sys
+import subprocess
+import unittest
+
+MODULES_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'modules')
+sys.path.insert(1, MODULES_DIR)
+
+from failures import classify, _machine_names, _normalize
+
+OUTPUT = """NOTE: Executing Tasks
+| qemux86-64/foo.c:12: error: 'x' undeclared for %(machine)s in mc:auh-%(mc)s:
+| /build/tmp-auh-%(mc)s/work/foo/1.0-r0/foo.c:13: error: conflicting types for 'y'
+ERROR: mc:auh-%(mc)s:foo-1.0-r0 do_compile: oe_runmake failed on %(machine)s
+ERROR: Task (mc:auh-%(mc)s:/layer/recipes/foo/foo_1.0.bb:do_compile) failed with exit code '1'
+"""
+
+FINGERPRINT = """
+import sys
+sys.path.insert(1, %r)
+from failures import classify
+machine = sys.argv[1]
+output = %r %% {'mc': machine.replace('_', '-'), 'machine': machine}
+print(classify(output.split("\\n"), "foo", machine).fingerprint)
+""" % (MODULES_DIR, OUTPUT)
+
+def _output(machine):
+    return (OUTPUT % {'mc': machine.replace('_', '-'),
+        'machine': machine}).split("\n")
+
+class TestFingerprint(unittest.TestCase):
+    def _fingerprint(self, machine, seed):
+        env = dict(os.environ)
+        env['PYTHONHASHSEED'] = str(seed)
+        return subprocess.check_output([sys.executable, "-c", FINGERPRINT,
+            machine], env=env, universal_newlines=True).strip()
+
+    def test_stable_across_hash_seeds(self):
+        for machine in ('qemux86', 'qemux86_musl', 'qemux86-64'):
+            fingerprints = set(self._fingerprint(machine, seed)
+                    for seed in range(8))
+            self.assertEqual(len(fingerprints), 1, machine)
+
+    def test_same_failure_same_fingerprint(self):
+        fingerprints = set(classify(_output(m), "foo", m).fingerprint
+                for m in ('qemux86', 'qemuarm', 'qemux86_musl'))
+        self.assertEqual(len(fingerprints), 1)
+
+    def test_overlapping_machine_names(self):
+        def normalize(line, machine):
+            return _normalize(line, _machine_names(machine))
+
+        self.assertEqual(normalize("mc:auh-qemux86-musl: qemux86_musl",
+            "qemux86_musl"), "mc:<machine>: <machine>")
+        # qemux86-64 is another machine, muslc isn't the C library
+        self.assertEqual(normalize("qemux86-64 qemux86 musl muslc",
+            "qemux86_musl"), "qemuxN-N <machine> <machine> muslc")
+        self.assertEqual(normalize("mc:auh-qemux86: qemux86-64",
+            "qemux86"), "mc:<machine>: qemuxN-N")
+
+if __name__ == '__main__':
+    unittest.main()
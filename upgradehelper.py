@@ -41,6 +41,8 @@ from logging import critical as C
 import re
 import signal
 import sys
+import threading
+import time
 import configparser as cp
 from datetime import datetime
 from datetime import date
@@ -53,11 +55,29 @@ from errors import *
 
 from utils.git import Git
 from utils.devtool import Devtool
+from utils.devtoolsession import DevtoolSession
 from utils.bitbake import *
+from utils.tinfoil import TinfoilSession
+from utils.envcache import EnvCache, CONF_FILES
+from utils.recipeindex import RecipeIndex
+from utils.builddir import WorkerBuildDir
 from utils.emailhandler import Email
+from utils import process
 
 from statistics import Statistics
-from steps import upgrade_steps
+from context import RecipeContext
+from steps import upgrade_steps, upgrade_stage_steps, compile_stage_steps
+from steps import devtool_reset
+from journal import Journal
+from timings import Timings, format_duration
+from attempts import Attempts, attempt_key, ATTEMPT_ENV_VARIABLES
+from pipeline import Pipeline, Stage
+from schedule import read_task_depends, schedule, TASK_DEPENDS
+from prefetch import Prefetch
+from upstream import UpstreamCheck
+from buildstats import total_cost
+from failures import FailureHistory
+import tracing
 from testimage import TestImage
 
 if not os.getenv('BUILDDIR', False):
@@ -88,6 +108,20 @@ help_text = """Usage examples:
 
 DEFAULT_TESTIMAGE = 'core-image-sato'
 
+ERROR_LOG = 'error_log.txt'
+
+# global variables AUH checks at startup
+BASE_ENV_VARIABLES = ('INHERIT', 'DISTRO_FEATURES', 'TMPDIR',
+                      'BUILDHISTORY_COMMIT', 'DL_DIR', 'SSTATE_DIR', 'BBLAYERS')
+
+def parse_duration(value):
+    """ Parses durations like 90m, 6h, 1h30m or 3600 (seconds) """
+    m = re.match(r"^(?:(\d+)h)?(?:(\d+)m)?(?:(\d+)s?)?$", value)
+    if not value or not m:
+        raise argparse.ArgumentTypeError("invalid duration: %s" % value)
+    hours, minutes, seconds = [int(g) if g else 0 for g in m.groups()]
+    return hours * 3600 + minutes * 60 + seconds
+
 def parse_cmdline():
     parser = argparse.ArgumentParser(description='Package Upgrade Helper',
                                      formatter_class=argparse.RawTextHelpFormatter,
@@ -105,6 +139,21 @@ def parse_cmdline():
                         help="do not compile, just change the checksums, remove PR, and commit")
     parser.add_argument("-c", "--config-file", default=None,
                         help="Path to the configuration file. Default is $BUILDDIR/upgrade-helper/upgrade-helper.conf")
+    parser.add_argument("--env-cache", default="use", choices=["use", "bypass", "rebuild"],
+                        help="use, bypass or rebuild the recipe environment cache in $BUILDDIR/upgrade-helper/env-cache")
+    parser.add_argument("--resume", default=None, metavar="WORKDIR",
+                        help="resume the run that was using WORKDIR, upgrading the recipes it didn't finish")
+    parser.add_argument("--trace", action="store_true", default=False,
+                        help="record where the time of the run goes, in trace.json (Chrome trace\n"
+                             "format) and trace_summary in the work directory")
+    parser.add_argument("--time-budget", type=parse_duration, default=None, metavar="DURATION",
+                        help="only upgrade the recipes that fit in DURATION (e.g. 6h, 90m, 1h30m)\n"
+                             "and don't start new upgrades once it is over")
+    parser.add_argument("--retry-failed", action="store_true", default=False,
+                        help="attempt again the upgrades that failed the same way in previous runs,"
+                             " whatever known_failure_policy is set to")
+    parser.add_argument("--refresh-upstream", action="store_true", default=False,
+                        help="check the upstream versions of all recipes again, ignoring the cached ones")
     return parser.parse_args()
 
 def parse_config_file(config_file):
@@ -142,14 +191,36 @@ def parse_config_file(config_file):
 
 class Updater(object):
     def __init__(self, args):
+        if args.trace:
+            tracing.enable()
+
+        self.deadline = None
+        if args.time_budget is not None:
+            self.deadline = time.time() + args.time_budget
+
         build_dir = get_build_dir()
+        os.chdir(build_dir)
+
+        self.tinfoil = None
+        devtool_session = False
+        if settings.get('tinfoil_session', 'yes') == 'yes':
+            devtool_session = settings.get('devtool_session', 'no') == 'yes'
+            self.tinfoil = TinfoilSession(build_dir, tracking=devtool_session)
 
-        self.bb = Bitbake(build_dir)
-        self.devtool = Devtool()
+        self.bb = Bitbake(build_dir, self.tinfoil)
+        if devtool_session:
+            self.devtool = DevtoolSession(self.tinfoil, lock=self.bb.lock)
+        else:
+            self.devtool = Devtool(self.tinfoil, lock=self.bb.lock)
         self.args = args
 
+        if self.args.env_cache != "bypass":
+            self.bb.set_env_cache(EnvCache(
+                os.path.join(build_dir, "upgrade-helper", "env-cache"),
+                build_dir, rebuild=(self.args.env_cache == "rebuild")))
+
         try:
-            self.base_env = self.bb.env()
+            self.base_env = self.bb.env(variables=BASE_ENV_VARIABLES)
         except EmptyEnvError as e:
             import traceback
             E( " %s\n%s" % (e.message, traceback.format_exc()))
@@ -158,13 +229,37 @@ class Updater(object):
 
         self._set_options()
 
+        # the session captures the whole process output while a command
+        # runs, the other threads would end up in it
+        if isinstance(self.devtool, DevtoolSession) and \
+                (self.opts['upgrade_workers'] > 0 or
+                 self.opts['prefetch_workers'] > 0 or
+                 self.opts['parallel_upgrades'] > 0):
+            W(" devtool_session ignored because upgrade_workers,"\
+              " prefetch_workers or parallel_upgrades is set!")
+            self.devtool = Devtool(self.tinfoil, lock=self.bb.lock)
+
         self._make_dirs(build_dir)
+        self.journal = Journal(self.uh_work_dir)
+        self.attempts = Attempts(os.path.join(self.uh_dir, "attempts.json"))
+        self.timings = Timings(os.path.join(self.uh_dir, "timings.db"),
+                os.path.basename(self.uh_work_dir))
+        self.failure_history = FailureHistory(os.path.join(self.uh_dir,
+                "failures.db"), os.path.basename(self.uh_work_dir))
+        self.known_failures = dict()
+        # attempted_pkgs is counted from the stages of pipelined upgrades
+        self.attempt_lock = threading.RLock()
+        if self.args.resume and self.journal.recipes is None:
+            E(" Nothing to resume in %s\n" % self.uh_work_dir)
+            exit(1)
 
         self._add_file_logger()
 
         if self.args.send_emails:
             self.email_handler = Email(settings)
         self.statistics = Statistics()
+        self.gcc_runtimes_thread = None
+        self.gcc_runtimes_cancelled = threading.Event()
 
     def _set_options(self):
         self.opts = {}
@@ -196,6 +291,33 @@ class Updater(object):
         self.opts['skip_compilation'] = self.args.skip_compilation
         self.opts['buildhistory'] = self._buildhistory_is_enabled()
         self.opts['testimage'] = self._testimage_is_enabled()
+        self.opts['parallel_upgrades'] = self._parallel_upgrades()
+        self.opts['parallel_machines'] = self._parallel_machines_is_enabled()
+        self.opts['build_once_per_arch'] = \
+            settings.get('build_once_per_arch', 'no') == 'yes'
+        self.opts['machine_tunes'] = dict()
+        # machine -> event set once its gcc runtime is built
+        self.opts['gcc_runtime_ready'] = dict()
+        self.opts['transient_retries'] = int(settings.get('transient_retries', '2'))
+        self.opts['transient_retry_delay'] = \
+            int(settings.get('transient_retry_delay', '60'))
+        self.opts['upgrade_workers'] = int(settings.get('upgrade_workers', '0'))
+        self.opts['upgrade_queue_size'] = int(settings.get('upgrade_queue_size', '2'))
+        self.opts['prefetch_workers'] = int(settings.get('prefetch_workers', '0'))
+        self.opts['dependency_order'] = \
+            settings.get('dependency_order', 'no') == 'yes'
+        self.opts['known_failure_policy'] = settings.get('known_failure_policy', 'retry')
+        if self.args.retry_failed:
+            self.opts['known_failure_policy'] = 'retry'
+        self.opts['upstream_cache_ttl'] = int(settings.get('upstream_cache_ttl', '20'))
+        self.opts['upstream_check_workers'] = int(settings.get('upstream_check_workers',
+            str(os.cpu_count())))
+        for operation in process.OPERATIONS:
+            minutes = int(settings.get('%s_timeout' % operation, '0'))
+            process.set_timeout(operation, minutes * 60)
+        if self.opts['parallel_upgrades'] > 0 and self.opts['upgrade_workers'] > 0:
+            W(" upgrade_workers ignored because parallel_upgrades is set!")
+            self.opts['upgrade_workers'] = 0
 
     def _make_dirs(self, build_dir):
         self.uh_dir = os.path.join(build_dir, "upgrade-helper")
@@ -209,15 +331,23 @@ class Updater(object):
                     self.opts['layer_name'])
         if not os.path.exists(self.uh_base_work_dir):
             os.mkdir(self.uh_base_work_dir)
-        self.uh_work_dir = os.path.join(self.uh_base_work_dir, "%s" % \
-                datetime.now().strftime("%Y%m%d%H%M%S"))
-        os.mkdir(self.uh_work_dir)
+        if self.args.resume:
+            self.uh_work_dir = os.path.abspath(self.args.resume)
+            if not os.path.isdir(self.uh_work_dir):
+                E(" %s is not a work directory\n" % self.args.resume)
+                exit(1)
+            self.uh_base_work_dir = os.path.dirname(self.uh_work_dir)
+        else:
+            self.uh_work_dir = os.path.join(self.uh_base_work_dir, "%s" % \
+                    datetime.now().strftime("%Y%m%d%H%M%S"))
+            os.mkdir(self.uh_work_dir)
         self.uh_recipes_all_dir = os.path.join(self.uh_work_dir, "all")
-        os.mkdir(self.uh_recipes_all_dir)
         self.uh_recipes_succeed_dir = os.path.join(self.uh_work_dir, "succeed")
-        os.mkdir(self.uh_recipes_succeed_dir)
         self.uh_recipes_failed_dir = os.path.join(self.uh_work_dir, "failed")
-        os.mkdir(self.uh_recipes_failed_dir)
+        for d in (self.uh_recipes_all_dir, self.uh_recipes_succeed_dir,
+                self.uh_recipes_failed_dir):
+            if not os.path.exists(d):
+                os.mkdir(d)
 
     def _add_file_logger(self):
         fh = log.FileHandler(os.path.join(self.uh_work_dir, "upgrade-helper.log"))
@@ -277,6 +407,31 @@ class Updater(object):
 
         return enabled
 
+    def _parallel_machines_is_enabled(self):
+        enabled = False
+
+        if settings.get("parallel_machines", "no") == "yes":
+            if self.opts['skip_compilation']:
+                pass
+            elif self.opts['buildhistory']:
+                W(" parallel_machines disabled because buildhistory is"\
+                  " enabled, machines will be built one after another!")
+            else:
+                self.bb.setup_multiconfig(self.opts['machines'])
+                enabled = True
+
+        return enabled
+
+    def _parallel_upgrades(self):
+        count = int(settings.get('parallel_upgrades', '0'))
+
+        if count > 0 and self.opts['buildhistory']:
+            W(" Buildhistory disabled because recipes are upgraded in"\
+              " parallel!")
+            self.opts['buildhistory'] = False
+
+        return count
+
     def _get_packages_to_upgrade(self, packages=None):
         if packages is None:
             I( "Nothing to upgrade")
@@ -284,6 +439,417 @@ class Updater(object):
         else:
             return packages
 
+    def _build_gcc_runtimes(self):
+        with tracing.span("gcc-runtimes", "run"):
+            try:
+                self._build_gcc_runtimes_for(self.opts['machines'])
+            finally:
+                # nothing waits for a machine that wasn't built
+                for ready in self.opts['gcc_runtime_ready'].values():
+                    ready.set()
+
+    def _gcc_runtime_log(self, machine):
+        return os.path.join(self.uh_work_dir, "gcc-runtime-%s.txt" % machine)
+
+    def _gcc_runtime_built(self, machine):
+        ready = self.opts['gcc_runtime_ready'].get(machine)
+        if ready is not None:
+            ready.set()
+
+    def _build_gcc_runtimes_for(self, machines):
+        I(" Building gcc runtimes ...")
+        if self.opts['parallel_machines']:
+            I("  building gcc runtime for %s" % ' '.join(machines))
+            log_file = self._gcc_runtime_log("multiconfig")
+            try:
+                self.bb.complete_multiconfig("gcc-runtime", machines,
+                        log_file=log_file)
+                return
+            except Error as e:
+                with open(log_file, errors='replace') as log:
+                    failed_mcs = set(mc for mc, _, _ in failed_tasks(log))
+                if failed_mcs and not None in failed_mcs:
+                    for machine in machines:
+                        if multiconfig_name(machine) in failed_mcs:
+                            E(" Can't build gcc-runtime for %s." % machine)
+                    E(e.stdout)
+                    E(" The full output is in %s" % log_file)
+                    return
+
+                W(" multiconfig build of gcc-runtime failed, building each"\
+                  " machine separately ...")
+
+        for machine in machines:
+            if self.gcc_runtimes_cancelled.is_set():
+                D(" Not building the remaining gcc runtimes, nothing to"\
+                  " upgrade")
+                return
+
+            I("  building gcc runtime for %s" % machine)
+            log_file = self._gcc_runtime_log(machine)
+            try:
+                self.bb.complete("gcc-runtime", machine, log_file=log_file)
+            except Exception as e:
+                E(" Can't build gcc-runtime for %s." % machine)
+
+                if isinstance(e, Error):
+                    E(e.stdout)
+                    E(" The full output is in %s" % log_file)
+                else:
+                    import traceback
+                    traceback.print_exc(file=sys.stdout)
+            # a failed gcc runtime fails the builds of the recipes on their
+            # own, they don't need to wait any longer
+            self._gcc_runtime_built(machine)
+
+    def _machine_tunes(self):
+        """ Returns the tune and C library of every machine, a recipe
+            whose PACKAGE_ARCH is the tune builds the same for machines that
+            share them. """
+        tunes = dict()
+        for machine in self.opts['machines']:
+            try:
+                env = self.bb.machine_env(machine, ['TUNE_PKGARCH', 'TCLIBC'])
+            except Error as e:
+                W(" Can't get the tune of %s, building everything for it: %s"
+                        % (machine, e.message))
+                continue
+            tunes[machine] = "%s %s" % (env.get('TUNE_PKGARCH'),
+                    env.get('TCLIBC'))
+        D(" Machine tunes: %s" % tunes)
+        return tunes
+
+    def _start_gcc_runtimes(self):
+        """ Builds the gcc runtimes in the background, machine by machine.
+            steps.compile() waits for the gcc runtime of the machine it
+            builds for, the upgrades don't wait for all of them. """
+        if self.gcc_runtimes_thread is not None:
+            return
+        self.opts['gcc_runtime_ready'] = dict((m, threading.Event())
+                for m in self.opts['machines'])
+        # not a daemon, a cancelled build finishes the machine it builds
+        # for rather than leaving bitbake behind
+        self.gcc_runtimes_thread = threading.Thread(
+                target=self._build_gcc_runtimes, name="gcc-runtimes")
+        self.gcc_runtimes_thread.start()
+
+    def _cancel_gcc_runtimes(self):
+        """ Stops building gcc runtimes once the current one is done """
+        if self.gcc_runtimes_thread is not None:
+            self.gcc_runtimes_cancelled.set()
+
+    def _schedule(self, pkgs_ctx):
+        """ Orders pkgs_ctx so that recipes come after the ones they
+            depend on. Returns the new list and the recipes each one
+            depends on. """
+        pns = [c.pn for c in pkgs_ctx]
+        I(" Ordering the recipes by their dependencies ...")
+        try:
+            self.bb.dependency_graph(' '.join(pns))
+            graph = read_task_depends(os.path.join(get_build_dir(),
+                TASK_DEPENDS))
+        except Error as e:
+            W(" Can't get the dependency graph, keeping the order: %s"
+                    % e.message)
+            return pkgs_ctx, {}
+        except OSError as e:
+            W(" Can't read the dependency graph, keeping the order: %s" % e)
+            return pkgs_ctx, {}
+
+        ordered, deps = schedule(pns, graph)
+        by_pn = dict((c.pn, c) for c in pkgs_ctx)
+        D(" Upgrade order: %s" % ' '.join(ordered))
+        return [by_pn[pn] for pn in ordered], deps
+
+    def _select_for_budget(self, pkgs_ctx, estimates):
+        """ Returns the recipes of pkgs_ctx that fit before the deadline,
+            the ones not attempted for the longest time and then the
+            cheapest ones first. The others are deferred. """
+        capacity = self.deadline - time.time()
+        if self.opts['parallel_upgrades'] > 0:
+            capacity *= self.opts['parallel_upgrades']
+
+        last = dict((c.pn, self.timings.last_attempt(c.pn) or 0)
+                for c in pkgs_ctx)
+        selected = set()
+        for c in sorted(pkgs_ctx, key=lambda c: (last[c.pn], estimates[c.pn])):
+            if estimates[c.pn] <= capacity:
+                selected.add(c.pn)
+                capacity -= estimates[c.pn]
+            else:
+                self._defer(c)
+
+        I(" %d of %d recipes fit in the time budget" % (len(selected),
+                len(pkgs_ctx)))
+        return [c for c in pkgs_ctx if c.pn in selected]
+
+    def _defer(self, pkg_ctx):
+        I(" %s: Not attempted, out of time" % pkg_ctx.pn)
+        self.deferred.add(pkg_ctx.pn)
+
+    def _out_of_time(self, pkg_ctx):
+        """ Whether upgrading pkg_ctx now would go past the deadline, in
+            which case it is deferred. """
+        if self.deadline is None:
+            return False
+
+        estimate = self.estimates.get(pkg_ctx.pn) or 0
+        if time.time() + estimate <= self.deadline:
+            return False
+
+        self._defer(pkg_ctx)
+        return True
+
+    def _attempt(self, pkg_ctx):
+        with self.attempt_lock:
+            self.attempted_pkgs += 1
+            I(" ATTEMPT PACKAGE %d/%d" % (self.attempted_pkgs, self.total_pkgs))
+        I(" %s: Upgrading to %s" % (pkg_ctx.pn, pkg_ctx.npv))
+        self.journal.start(pkg_ctx.pn)
+
+        # machines that failed the most before are built first
+        if len(self.opts['machines']) > 1:
+            pkg_ctx.machine_order = self.failure_history.machine_order(
+                    pkg_ctx.pn, self.opts['machines'])
+            pkg_ctx.known_fingerprints = self.failure_history.fingerprints(
+                    pkg_ctx.pn)
+
+    def _run_steps(self, pkg_ctx, steps, devtool, bb):
+        try:
+            for step, msg in steps:
+                if msg is not None:
+                    I(" %s: %s" % (pkg_ctx.pn, msg))
+                started = time.time()
+                try:
+                    with tracing.span(step.__name__, "step", pn=pkg_ctx.pn):
+                        step(devtool, bb, self.git, self.opts, pkg_ctx)
+                finally:
+                    pkg_ctx.timings.append((step.__name__, None, started,
+                        time.time() - started))
+                self.journal.step(pkg_ctx.pn, step.__name__,
+                        pkg_ctx.recipe_dir)
+        except Exception as e:
+            if isinstance(e, UpgradeNotNeededError):
+                I(" %s: %s" % (pkg_ctx.pn, e.message))
+            elif isinstance(e, UnsupportedProtocolError):
+                I(" %s: %s" % (pkg_ctx.pn, e.message))
+            else:
+                if not isinstance(e, Error):
+                    import traceback
+                    msg = "Failed(unknown error)\n" + traceback.format_exc()
+                    e = Error(message=msg)
+                    error = e
+
+                E(" %s: %s" % (pkg_ctx.pn, e.message))
+
+                if pkg_ctx.workdir is not None and os.listdir(pkg_ctx.workdir):
+                    E(" %s: Upgrade FAILED! Logs and/or file diffs are available in %s"
+                        % (pkg_ctx.pn, pkg_ctx.workdir))
+
+            pkg_ctx.error = e
+
+    def _retry_later(self, pkg_ctx, worktree_git=None):
+        """ Whether pkg_ctx failed for a reason that may go away (network,
+            mirrors), it is then undone to be upgraded again later. """
+        error = pkg_ctx.error
+        if error is None or not error.transient or \
+                pkg_ctx.retries >= self.opts['transient_retries']:
+            return False
+
+        # what devtool finish left in the recipe directory, upgrades in a
+        # worktree left nothing here. Other recipes may be upgraded in the
+        # layer meanwhile, only this one is undone.
+        recipe_dir = pkg_ctx.recipe_dir
+        if worktree_git is None and recipe_dir is not None and \
+                recipe_dir.startswith(self.git.repo_dir.rstrip("/") + "/"):
+            try:
+                self.git.reset_path(recipe_dir)
+                self.git.clean_untracked(recipe_dir)
+            except Error as e:
+                W(" %s: Can't undo the upgrade to retry it: %s" % (pkg_ctx.pn,
+                        e.message))
+                return False
+
+        if pkg_ctx.workdir is not None and os.path.exists(pkg_ctx.workdir):
+            shutil.rmtree(pkg_ctx.workdir)
+
+        pkg_ctx.retries += 1
+        delay = self.opts['transient_retry_delay'] * 2 ** (pkg_ctx.retries - 1)
+        pkg_ctx.retry_at = time.time() + delay
+        W(" %s: The failure looks temporary, retrying in %d seconds at the"\
+          " earliest (%d/%d)" % (pkg_ctx.pn, delay, pkg_ctx.retries,
+                self.opts['transient_retries']))
+        pkg_ctx.reset()
+        with self.attempt_lock:
+            self.attempted_pkgs -= 1
+        self.retry_pkgs_ctx.append(pkg_ctx)
+        return True
+
+    def _finish(self, pkg_ctx, worktree_git=None):
+        if self._retry_later(pkg_ctx, worktree_git):
+            return
+
+        if pkg_ctx.error is None:
+            self.succeeded_pkgs_ctx.append(pkg_ctx)
+            I(" %s: Upgrade SUCCESSFUL! Please test!" % pkg_ctx.pn)
+        else:
+            self.failed_pkgs_ctx.append(pkg_ctx)
+
+        try:
+            self.commit_changes(pkg_ctx, worktree_git)
+        except:
+            if pkg_ctx in self.succeeded_pkgs_ctx:
+                self.succeeded_pkgs_ctx.remove(pkg_ctx)
+                self.failed_pkgs_ctx.append(pkg_ctx)
+
+        # contexts are kept until the end of the run, don't keep the
+        # build output in memory
+        if pkg_ctx.error is not None and pkg_ctx.workdir is not None:
+            pkg_ctx.error.save_log(os.path.join(pkg_ctx.workdir, ERROR_LOG))
+        pkg_ctx.buildhistory = None
+
+        if pkg_ctx.attempt_key is not None:
+            self.attempts.record(pkg_ctx, pkg_ctx.attempt_key)
+
+        self.timings.record(pkg_ctx)
+        pkg_ctx.timings = []
+        self.failure_history.record(pkg_ctx)
+
+        self.journal.finish(pkg_ctx, pkg_ctx in self.succeeded_pkgs_ctx)
+
+    def _rollback(self, pns):
+        """ Undoes what the resumed run left of the upgrades it didn't
+            finish, they are done again from the start. """
+        devtools = [self.devtool]
+        workers_dir = os.path.join(self.uh_dir, "workers")
+        if os.path.exists(workers_dir):
+            for w in sorted(os.listdir(workers_dir)):
+                devtools.append(Devtool(basepath=os.path.join(workers_dir, w)))
+
+        for pn in pns:
+            W(" %s: Rolling back the unfinished upgrade ..." % pn)
+            for devtool in devtools:
+                try:
+                    devtool_reset(devtool, pn)
+                except DevtoolError:
+                    pass
+
+            try:
+                # the commit may have been reverted already
+                commit = self.journal.commits.get(pn)
+                if commit is not None:
+                    if self.git.last_commit("HEAD") == commit:
+                        self.git.reset_hard(1)
+                    elif self.git.last_commit("HEAD~1") == commit:
+                        self.git.reset_hard(2)
+
+                self.git.reset_hard()
+                # recipes upgraded in a worktree left nothing here
+                recipe_dir = self.journal.recipe_dirs.get(pn)
+                if recipe_dir is not None and recipe_dir.startswith(
+                        self.git.repo_dir.rstrip("/") + "/"):
+                    self.git.clean_untracked(recipe_dir)
+            except Error as e:
+                W(" %s: Rolling back failed, you may need to clean %s:\n%s"
+                        % (pn, self.git.repo_dir, e.stdout))
+
+            workdir = os.path.join(self.uh_recipes_all_dir, pn)
+            if os.path.exists(workdir):
+                shutil.rmtree(workdir)
+            self.timings.forget(pn)
+            self.failure_history.forget(pn)
+
+    def _get_workers(self, count, worktrees=False):
+        workers = []
+        for i in range(count):
+            worker_dir = os.path.join(self.uh_dir, "workers", str(i))
+            worker = WorkerBuildDir(get_build_dir(), worker_dir,
+                self.base_env, self.git if worktrees else None)
+            if self.opts['parallel_machines']:
+                worker.bb.setup_multiconfig(self.opts['machines'])
+            workers.append(worker)
+        return workers
+
+    def _run_pipelined(self, pkgs_ctx):
+        """ Runs 'devtool upgrade' of the next recipes on worker build
+            directories while the main one builds the current recipe. The
+            remaining steps and commits happen in the original order. """
+        workers = self._get_workers(self.opts['upgrade_workers'])
+
+        def upgrade_stage(pkg_ctx, worker):
+            pkg_ctx.worker = worker
+            with self.attempt_lock:
+                if self._out_of_time(pkg_ctx):
+                    return
+                self._attempt(pkg_ctx)
+            self._run_steps(pkg_ctx, upgrade_stage_steps,
+                    workers[worker].devtool, workers[worker].bb)
+
+        def compile_stage(pkg_ctx, worker):
+            if pkg_ctx.pn in self.deferred:
+                return
+
+            # devtool finish has to run where the recipe was upgraded
+            if pkg_ctx.error is None:
+                self._run_steps(pkg_ctx, compile_stage_steps,
+                        workers[pkg_ctx.worker].devtool, self.bb)
+            self._finish(pkg_ctx)
+
+        I(" Upgrading with %d workers ..." % len(workers))
+        pipeline = Pipeline([
+                Stage("upgrade", upgrade_stage, len(workers)),
+                Stage("compile", compile_stage, ordered=True),
+            ], len(workers) + self.opts['upgrade_queue_size'])
+        pipeline.run(pkgs_ctx)
+
+    def _run_isolated(self, pkgs_ctx):
+        """ Upgrades several recipes at once. Each worker build directory
+            has its own worktree, the upgrade is committed there and then
+            cherry-picked onto the current branch, in the order the
+            upgrades complete. """
+        workers = self._get_workers(self.opts['parallel_upgrades'],
+                worktrees=True)
+        commit_lock = threading.Lock()
+
+        def upgrade(pkg_ctx, worker):
+            pkg_ctx.worker = worker
+            with commit_lock:
+                if self._out_of_time(pkg_ctx):
+                    return
+                self._attempt(pkg_ctx)
+                head = self.git.last_commit("HEAD")
+            workers[worker].reset_worktree(head)
+
+            self._run_steps(pkg_ctx, upgrade_steps, workers[worker].devtool,
+                    workers[worker].bb)
+
+            with commit_lock:
+                self._finish(pkg_ctx, workers[worker].git)
+
+        # a recipe starts once the ones it depends on are on the branch
+        by_pn = dict((c.pn, c) for c in pkgs_ctx)
+        def depends(pkg_ctx):
+            return [by_pn[pn] for pn in self.pkg_deps.get(pkg_ctx.pn, ())
+                    if pn in by_pn]
+
+        I(" Upgrading %d recipes at a time ..." % len(workers))
+        pipeline = Pipeline([Stage("upgrade", upgrade, len(workers))],
+                len(workers))
+        pipeline.run(pkgs_ctx, depends)
+
+    def _upgrade(self, pkgs_ctx):
+        if self.opts['parallel_upgrades'] > 0:
+            self._run_isolated(pkgs_ctx)
+        elif self.opts['upgrade_workers'] > 0:
+            self._run_pipelined(pkgs_ctx)
+        else:
+            for pkg_ctx in pkgs_ctx:
+                if self._out_of_time(pkg_ctx):
+                    continue
+                self._attempt(pkg_ctx)
+                self._run_steps(pkg_ctx, upgrade_steps, self.devtool, self.bb)
+                self._finish(pkg_ctx)
+
     # this function will be called at the end of each recipe upgrade
     def pkg_upgrade_handler(self, pkg_ctx):
         mail_header = \
@@ -313,55 +879,58 @@ class Updater(object):
             "Any problem please file a bug at https://bugzilla.yoctoproject.org/enter_bug.cgi?product=Automated%20Update%20Handler\n\n" \
             "Regards,\nThe Upgrade Helper"
 
-        if pkg_ctx['MAINTAINER'] in maintainer_override:
-            to_addr = maintainer_override[pkg_ctx['MAINTAINER']]
+        if pkg_ctx.maintainer in maintainer_override:
+            to_addr = maintainer_override[pkg_ctx.maintainer]
         elif 'global_maintainer_override' in settings:
             to_addr = settings['global_maintainer_override']
         else:
-            to_addr = pkg_ctx['MAINTAINER']
+            to_addr = pkg_ctx.maintainer
 
         cc_addr = None
         if "cc_recipients" in settings:
             cc_addr = settings["cc_recipients"].split()
 
-        newversion = pkg_ctx['NPV'] if not pkg_ctx['NPV'].endswith("new-commits-available") else pkg_ctx['NSRCREV']
-        subject = "[AUH] " + pkg_ctx['PN'] + ": upgrading to " + newversion
-        if not pkg_ctx['error']:
+        newversion = pkg_ctx.npv if not pkg_ctx.npv.endswith("new-commits-available") else pkg_ctx.nsrcrev
+        subject = "[AUH] " + pkg_ctx.pn + ": upgrading to " + newversion
+        if not pkg_ctx.error:
             subject += " SUCCEEDED"
         else:
             subject += " FAILED"
-        msg_body = mail_header % (pkg_ctx['PN'], newversion,
-                self._get_status_msg(pkg_ctx['error']))
+        msg_body = mail_header % (pkg_ctx.pn, newversion,
+                self._get_status_msg(pkg_ctx.error))
 
-        if pkg_ctx['error'] is not None:
+        if pkg_ctx.error is not None:
             msg_body += """Detailed error information:
 
 %s
 %s
-%s
 
-""" %(pkg_ctx['error'].message if pkg_ctx['error'].message else "", pkg_ctx['error'].stdout if pkg_ctx['error'].stdout else "" , pkg_ctx['error'].stderr if pkg_ctx['error'].stderr else "")
+""" %(pkg_ctx.error.message if pkg_ctx.error.message else "", pkg_ctx.error.get_output())
 
-        if 'license_diff_fn' in pkg_ctx:
-            license_diff_fn = pkg_ctx['license_diff_fn']
+        if pkg_ctx.license_diff_fn is not None:
+            license_diff_fn = pkg_ctx.license_diff_fn
             msg_body += license_change_info % license_diff_fn
 
-        if 'patch_file' in pkg_ctx and pkg_ctx['patch_file'] != None:
-            msg_body += next_steps_info % (os.path.basename(pkg_ctx['patch_file']))
+        if pkg_ctx.patch_file is not None:
+            msg_body += next_steps_info % (os.path.basename(pkg_ctx.patch_file))
 
         msg_body += mail_footer
 
         # Add possible attachments to email
         attachments = []
-        for attachment in os.listdir(pkg_ctx['workdir']):
-            attachment_fullpath = os.path.join(pkg_ctx['workdir'], attachment)
+        for attachment in os.listdir(pkg_ctx.workdir):
+            # the error output is already part of the message body
+            if attachment == ERROR_LOG:
+                continue
+            attachment_fullpath = os.path.join(pkg_ctx.workdir, attachment)
             if os.path.isfile(attachment_fullpath):
                 attachments.append(attachment_fullpath)
 
         if self.opts['send_email']:
-            self.email_handler.send_email(to_addr, subject, msg_body, attachments, cc_addr=cc_addr)
+            with tracing.span("email", "run", pn=pkg_ctx.pn):
+                self.email_handler.send_email(to_addr, subject, msg_body, attachments, cc_addr=cc_addr)
         # Preserve email for review purposes.
-        email_file = os.path.join(pkg_ctx['workdir'],
+        email_file = os.path.join(pkg_ctx.workdir,
                     "email_summary")
         with open(email_file, "w+") as f:
             f.write("To: %s\n" % to_addr)
@@ -374,26 +943,39 @@ class Updater(object):
             f.write("Attachments: %s\n" % ' '.join(attachments))
             f.write("\n%s\n" % msg_body)
 
-    def commit_changes(self, pkg_ctx):
+    def commit_changes(self, pkg_ctx, worktree_git=None):
+        """ If worktree_git is given the recipe was upgraded in that
+            worktree, the commit is made there and cherry-picked. """
+        git = worktree_git if worktree_git is not None else self.git
         try:
-            pkg_ctx['patch_file'] = None
+            pkg_ctx.patch_file = None
 
-            I(" %s: Auto commit changes ..." % pkg_ctx['PN'])
-            self.git.add(pkg_ctx['recipe_dir'])
-            self.git.commit(pkg_ctx['commit_msg'], self.opts['author'])
+            I(" %s: Auto commit changes ..." % pkg_ctx.pn)
+            git.add(pkg_ctx.recipe_dir)
+            git.commit(pkg_ctx.commit_msg, self.opts['author'])
 
-            stdout = self.git.create_patch(pkg_ctx['workdir'])
-            pkg_ctx['patch_file'] = stdout.strip()
+            stdout = git.create_patch(pkg_ctx.workdir)
+            pkg_ctx.patch_file = stdout.strip()
 
-            if not pkg_ctx['patch_file']:
+            if not pkg_ctx.patch_file:
                 msg = "Patch file not generated."
-                E(" %s: %s\n %s" % (pkg_ctx['PN'], msg, stdout))
+                E(" %s: %s\n %s" % (pkg_ctx.pn, msg, stdout))
                 raise Error(msg, stdout)
             else:
                 I(" %s: Save patch in directory: %s." %
-                    (pkg_ctx['PN'], pkg_ctx['workdir']))
+                    (pkg_ctx.pn, pkg_ctx.workdir))
+
+            if worktree_git is not None:
+                I(" %s: Cherry-picking the upgrade ..." % pkg_ctx.pn)
+                commit = worktree_git.last_commit("HEAD")
+                try:
+                    self.git.cherry_pick(commit)
+                except Error:
+                    self.git.abort_cherry_pick()
+                    raise
+            self.journal.commit(pkg_ctx.pn, self.git.last_commit("HEAD"))
             revert_policy = settings.get('commit_revert_policy', 'failed_to_build')
-            if (pkg_ctx['error'] is not None and revert_policy == 'failed_to_build'):
+            if (pkg_ctx.error is not None and revert_policy == 'failed_to_build'):
                 I("Due to build errors, the commit will also be reverted to avoid cascading upgrade failures.")
                 self.git.revert("HEAD")
             elif revert_policy == 'all':
@@ -405,9 +987,9 @@ class Updater(object):
             for line in e.stdout.split("\n"):
                 if line.find("nothing to commit") == 0:
                     msg = "Nothing to commit!"
-                    I(" %s: %s" % (pkg_ctx['PN'], msg))
+                    I(" %s: %s" % (pkg_ctx.pn, msg))
 
-            I(" %s: %s" % (pkg_ctx['PN'], e.stdout))
+            I(" %s: %s" % (pkg_ctx.pn, e.stdout))
             raise e
 
     def send_status_mail(self, statistics_summary):
@@ -424,13 +1006,19 @@ class Updater(object):
             subject = "[AUH] Upgrade status: " + date.isoformat(date.today())
 
         if self.statistics.total_attempted:
-            self.email_handler.send_email(to_list, subject, statistics_summary)
+            with tracing.span("email", "run"):
+                self.email_handler.send_email(to_list, subject, statistics_summary)
         else:
             W("No recipes attempted, not sending status mail!")
 
     def run(self, package_list=None):
-        pkgs_to_upgrade = self._get_packages_to_upgrade(package_list)
-        total_pkgs = len(pkgs_to_upgrade)
+        if self.args.resume:
+            I(" Resuming the run in %s ..." % self.uh_work_dir)
+            pkgs_to_upgrade = self.journal.recipes
+        else:
+            pkgs_to_upgrade = self._get_packages_to_upgrade(package_list)
+            self.journal.run(pkgs_to_upgrade)
+        self.total_pkgs = len(pkgs_to_upgrade)
 
         pkgs_ctx = {}
 
@@ -438,76 +1026,102 @@ class Updater(object):
         for p, ov, nv, m, r in pkgs_to_upgrade:
             I(" %s, %s, %s, %s, %s" % (p, ov, nv, m, r))
 
-            pkgs_ctx[p] = {}
-            pkgs_ctx[p]['PN'] = p
-            pkgs_ctx[p]['PV'] = ov
-            pkgs_ctx[p]['NPV'] = nv
-            pkgs_ctx[p]['MAINTAINER'] = m
-            pkgs_ctx[p]['NSRCREV'] = r
-
-            pkgs_ctx[p]['base_dir'] = self.uh_recipes_all_dir
+            pkgs_ctx[p] = RecipeContext(p, ov, nv, m, r,
+                    self.uh_recipes_all_dir)
+
+        pending = [p for p, _, _, _, _ in pkgs_to_upgrade
+                if not p in self.journal.done and not p in self.known_failures]
+        self.estimates, known = self.timings.estimates(pending)
+        estimates = self.estimates
+        if known:
+            total = sum(estimates.values())
+            if self.opts['parallel_upgrades'] > 0:
+                total /= self.opts['parallel_upgrades']
+            I(" Estimated duration: %s (%d of %d recipes upgraded before)"
+                    % (format_duration(total), known, len(pending)))
         I(" ############################################################")
 
-        if pkgs_to_upgrade and not self.args.skip_compilation:
-            I(" Building gcc runtimes ...")
-            for machine in self.opts['machines']:
-                I("  building gcc runtime for %s" % machine)
-                try:
-                    self.bb.complete("gcc-runtime", machine)
-                except Exception as e:
-                    E(" Can't build gcc-runtime for %s." % machine)
-
-                    if isinstance(e, Error):
-                        E(e.stdout)
-                    else:
-                        import traceback
-                        traceback.print_exc(file=sys.stdout)
-
-        succeeded_pkgs_ctx = []
-        failed_pkgs_ctx = []
-        attempted_pkgs = 0
+        self.succeeded_pkgs_ctx = succeeded_pkgs_ctx = []
+        self.failed_pkgs_ctx = failed_pkgs_ctx = []
+        ordered_pkgs_ctx = []
         for pn, _, _, _, _ in pkgs_to_upgrade:
             pkg_ctx = pkgs_ctx[pn]
-            pkg_ctx['error'] = None
-
-            attempted_pkgs += 1
-            I(" ATTEMPT PACKAGE %d/%d" % (attempted_pkgs, total_pkgs))
-            try:
-                I(" %s: Upgrading to %s" % (pkg_ctx['PN'], pkg_ctx['NPV']))
-                for step, msg in upgrade_steps:
-                    if msg is not None:
-                        I(" %s: %s" % (pkg_ctx['PN'], msg))
-                    step(self.devtool, self.bb, self.git, self.opts, pkg_ctx)
-                succeeded_pkgs_ctx.append(pkg_ctx)
-
-                I(" %s: Upgrade SUCCESSFUL! Please test!" % pkg_ctx['PN'])
-            except Exception as e:
-                if isinstance(e, UpgradeNotNeededError):
-                    I(" %s: %s" % (pkg_ctx['PN'], e.message))
-                elif isinstance(e, UnsupportedProtocolError):
-                    I(" %s: %s" % (pkg_ctx['PN'], e.message))
+            if pn in self.journal.done:
+                if self.journal.restore(pkg_ctx):
+                    succeeded_pkgs_ctx.append(pkg_ctx)
                 else:
-                    if not isinstance(e, Error):
-                        import traceback
-                        msg = "Failed(unknown error)\n" + traceback.format_exc()
-                        e = Error(message=msg)
-                        error = e
-
-                    E(" %s: %s" % (pkg_ctx['PN'], e.message))
-
-                    if 'workdir' in pkg_ctx and os.listdir(pkg_ctx['workdir']):
-                        E(" %s: Upgrade FAILED! Logs and/or file diffs are available in %s"
-                            % (pkg_ctx['PN'], pkg_ctx['workdir']))
-
-                pkg_ctx['error'] = e
-                failed_pkgs_ctx.append(pkg_ctx)
-
-            try:
-                self.commit_changes(pkg_ctx)
-            except:
-                if pkg_ctx in succeeded_pkgs_ctx:
-                    succeeded_pkgs_ctx.remove(pkg_ctx)
                     failed_pkgs_ctx.append(pkg_ctx)
+            elif pn in self.known_failures:
+                I(" %s: The same upgrade failed before, reporting it again"
+                        % pn)
+                self.attempts.restore(pkg_ctx, self.known_failures[pn])
+                failed_pkgs_ctx.append(pkg_ctx)
+                self.journal.finish(pkg_ctx, False)
+            else:
+                ordered_pkgs_ctx.append(pkg_ctx)
+        self.attempted_pkgs = len(pkgs_to_upgrade) - len(ordered_pkgs_ctx)
+        if self.args.resume:
+            I(" %d recipes done already, %d left" % (self.attempted_pkgs,
+                len(ordered_pkgs_ctx)))
+            self._rollback(self.journal.half_done())
+
+        self.deferred = set()
+        if self.deadline is not None:
+            if known:
+                ordered_pkgs_ctx = self._select_for_budget(ordered_pkgs_ctx,
+                        estimates)
+            else:
+                W(" No timings of previous runs, upgrading until the time"\
+                  " budget is over")
+
+        # the downloads go on while the gcc runtimes are built
+        prefetch = None
+        if ordered_pkgs_ctx and self.opts['prefetch_workers'] > 0:
+            prefetch = Prefetch(os.path.join(self.uh_dir, "prefetch"),
+                    self.base_env, self.opts['prefetch_workers'])
+            prefetch.start(ordered_pkgs_ctx, self.uh_work_dir)
+
+        if not ordered_pkgs_ctx:
+            self._cancel_gcc_runtimes()
+        elif not self.args.skip_compilation:
+            self._start_gcc_runtimes()
+
+        if ordered_pkgs_ctx and not self.args.skip_compilation and \
+                self.opts['build_once_per_arch'] and len(self.opts['machines']) > 1:
+            self.opts['machine_tunes'] = self._machine_tunes()
+
+        # longest upgrades first, so that no worker is left with a long one
+        # at the end
+        if self.opts['parallel_upgrades'] > 0 and known:
+            ordered_pkgs_ctx.sort(key=lambda c: -estimates[c.pn])
+
+        self.pkg_deps = dict()
+        if self.opts['dependency_order'] and len(ordered_pkgs_ctx) > 1:
+            ordered_pkgs_ctx, self.pkg_deps = self._schedule(ordered_pkgs_ctx)
+
+        if prefetch is not None:
+            prefetch.wait()
+
+        # recipes that failed for temporary reasons are upgraded again
+        # once the others are done
+        while ordered_pkgs_ctx:
+            self.retry_pkgs_ctx = []
+            self._upgrade(ordered_pkgs_ctx)
+
+            ordered_pkgs_ctx = self.retry_pkgs_ctx
+            if ordered_pkgs_ctx:
+                wait = max(c.retry_at for c in ordered_pkgs_ctx) - time.time()
+                if self.deadline is not None and \
+                        time.time() + wait > self.deadline:
+                    for pkg_ctx in ordered_pkgs_ctx:
+                        self._defer(pkg_ctx)
+                    break
+                I(" Retrying %d recipes after temporary failures%s ..." % (
+                    len(ordered_pkgs_ctx),
+                    " in %d seconds" % wait if wait > 0 else ""))
+                if wait > 0:
+                    time.sleep(wait)
+        attempted_pkgs = self.attempted_pkgs
 
         if self.opts['testimage']:
             ctxs = {}
@@ -517,20 +1131,38 @@ class Updater(object):
             tim = TestImage(self.bb, self.git, self.uh_work_dir, self.opts,
                    ctxs, image)
 
-            tim.run()
+            with tracing.span("testimage", "run"):
+                tim.run()
 
         for pn in pkgs_ctx.keys():
             pkg_ctx = pkgs_ctx[pn]
+            if pn in self.deferred:
+                self.statistics.defer(pkg_ctx.pn, pkg_ctx.npv,
+                        pkg_ctx.maintainer)
+                continue
+
+            # a resumed run may have linked them already
+            for d in (self.uh_recipes_succeed_dir, self.uh_recipes_failed_dir):
+                if os.path.lexists(os.path.join(d, pkg_ctx.pn)):
+                    os.remove(os.path.join(d, pkg_ctx.pn))
 
             if pkg_ctx in succeeded_pkgs_ctx:
-                os.symlink(pkg_ctx['workdir'], os.path.join( \
-                    self.uh_recipes_succeed_dir, pkg_ctx['PN']))
+                os.symlink(pkg_ctx.workdir, os.path.join( \
+                    self.uh_recipes_succeed_dir, pkg_ctx.pn))
             else:
-                os.symlink(pkg_ctx['workdir'], os.path.join( \
-                    self.uh_recipes_failed_dir, pkg_ctx['PN']))
-
-            self.statistics.update(pkg_ctx['PN'], pkg_ctx['NPV'],
-                    pkg_ctx['MAINTAINER'], pkg_ctx['error'])
+                os.symlink(pkg_ctx.workdir, os.path.join( \
+                    self.uh_recipes_failed_dir, pkg_ctx.pn))
+
+            self.statistics.update(pkg_ctx.pn, pkg_ctx.npv,
+                    pkg_ctx.maintainer, pkg_ctx.error)
+            if pkg_ctx.retries:
+                self.statistics.retry(pkg_ctx.pn, pkg_ctx.retries,
+                        pkg_ctx.error)
+            if pkg_ctx.covered_machines:
+                self.statistics.cover(pkg_ctx.pn, pkg_ctx.covered_machines)
+            if pkg_ctx.build_costs:
+                self.statistics.build_cost(pkg_ctx.pn,
+                        *total_cost(pkg_ctx.build_costs.values()))
             self.pkg_upgrade_handler(pkg_ctx)
 
         if attempted_pkgs > 0:
@@ -541,7 +1173,9 @@ class Updater(object):
                 I(" Generating work tarball in %s ..." % work_tarball)
                 tar_cmd = ["tar", "-chzf", work_tarball, "-C", self.uh_base_work_dir, os.path.basename(self.uh_work_dir)]
                 import subprocess
-                if subprocess.call(tar_cmd):
+                with tracing.span("tarball", "run"):
+                    tar_failed = subprocess.call(tar_cmd)
+                if tar_failed:
                     E(" Work tarball (%s) generation failed..." % (work_tarball))
                     E(" Tar command: %s" % (" ".join(tar_cmd)))
                     publish_work_url = ''
@@ -559,6 +1193,17 @@ class Updater(object):
             if self.opts['send_email']:
                 self.send_status_mail(statistics_summary)
 
+        if tracing.enabled():
+            tracing.write(os.path.join(self.uh_work_dir, "trace.json"))
+            with open(os.path.join(self.uh_work_dir, "trace_summary"), "w") as f:
+                f.write(tracing.summary())
+            I(" Trace written to %s" % self.uh_work_dir)
+
+        self.timings.close()
+        self.failure_history.close()
+        if self.tinfoil is not None:
+            self.tinfoil.close()
+
 class UniverseUpdater(Updater):
     def __init__(self, args):
         Updater.__init__(self, args)
@@ -581,29 +1226,25 @@ class UniverseUpdater(Updater):
                 exit(1)
 
     def _get_recipes_by_layer(self):
-        recipes = []
+        index = RecipeIndex(os.path.join(self.uh_dir, "recipe-index.json"),
+                self.base_env['BBLAYERS'],
+                [os.path.join(get_build_dir(), f) for f in CONF_FILES])
 
-        recipe_regex = re.compile('^(?P<name>.*):$')
-        layer_regex = re.compile('^  (?P<name>.*) +')
-
-        layers = False
-        name = ''
-
-        output = subprocess.check_output('bitbake-layers show-recipes',
-                shell=True)
-        for line in output.decode("utf-8") .split('\n'):
-            s = recipe_regex.search(line)
-            if s:
-                name = s.group('name')
-                continue
-
-            if not 'skipped' in line:
-                s = layer_regex.search(line)
-                if s:
-                    if s.group('name').strip() == self.opts['layer_name']:
-                        recipes.append(name)
+        tinfoil = self.tinfoil
+        if tinfoil is None:
+            tinfoil = TinfoilSession(get_build_dir())
+        try:
+            index.update(tinfoil)
+        except Error as e:
+            E(" %s" % e.message)
+            exit(1)
+        finally:
+            if tinfoil is not self.tinfoil:
+                tinfoil.close()
+            else:
+                tinfoil.release()
 
-        return recipes
+        return index.recipes(self.opts['layer_name'])
 
     def _prepare(self):
         if settings.get("clean_sstate", "no") == "yes" and \
@@ -650,9 +1291,47 @@ class UniverseUpdater(Updater):
 
         return True
 
-    def _get_packages_to_upgrade(self, packages=None):
+    def _known_failure(self, pn, pv, npv, nsrcrev):
+        """ Returns the failure of the same upgrade in a previous run or
+            None. """
+        if self.opts['known_failure_policy'] == 'retry' or \
+                not self.attempts.candidate(pn, pv, npv, nsrcrev):
+            return None
 
-        pkgs = oe.recipeutils.get_recipe_upgrade_status(self.recipes)
+        try:
+            env = self.bb.env(pn, ATTEMPT_ENV_VARIABLES)
+        except Error as e:
+            D(" %s: %s" % (pn, e.message))
+            return None
+
+        return self.attempts.known_failure(pn,
+                attempt_key(pn, pv, npv, nsrcrev, env))
+
+    def _get_packages_to_upgrade(self, packages=None):
+        tinfoil = self.tinfoil
+        if tinfoil is None:
+            tinfoil = TinfoilSession(get_build_dir())
+
+        upstream = UpstreamCheck(tinfoil,
+                os.path.join(self.uh_dir, "upstream-cache.json"),
+                self.opts['upstream_cache_ttl'],
+                self.opts['upstream_check_workers'],
+                self.args.refresh_upstream)
+        try:
+            pending = upstream.prepare(self.recipes)
+        except Error as e:
+            E(" %s" % e.message)
+            exit(1)
+        finally:
+            if tinfoil is not self.tinfoil:
+                tinfoil.close()
+
+        # the checks are mostly waiting on the network, build the gcc
+        # runtimes meanwhile once there is something to upgrade
+        if pending and not self.args.skip_compilation:
+            pkgs = upstream.check(self._start_gcc_runtimes)
+        else:
+            pkgs = upstream.check()
 
         pkgs_list = []
         for pkg in pkgs:
@@ -666,7 +1345,16 @@ class UniverseUpdater(Updater):
                 if self.recipes and pn in self.recipes:
                     pkgs_list.append((pn, cur_ver, next_ver, maintainer, revision))
                 elif self._pkg_upgradable(pn, next_ver, maintainer):
-                    pkgs_list.append((pn, cur_ver, next_ver, maintainer, revision))
+                    failure = self._known_failure(pn, cur_ver, next_ver,
+                            revision)
+                    if failure is None:
+                        pkgs_list.append((pn, cur_ver, next_ver, maintainer, revision))
+                    elif self.opts['known_failure_policy'] == 'skip':
+                        I(" Skip package %s: upgrading it to %s failed before"\
+                          " (%s)" % (pn, next_ver, failure['error']['type']))
+                    else:
+                        self.known_failures[pn] = failure
+                        pkgs_list.append((pn, cur_ver, next_ver, maintainer, revision))
             else:
                 if no_upgrade_reason:
                     I(" Skip package %s (status = %s, current version = %s," \
@@ -687,6 +1375,7 @@ class UniverseUpdater(Updater):
         super(UniverseUpdater, self).run()
 
 def close_child_processes(signal_id, frame):
+    process.kill_all()
     pid = os.getpgrp()
     os.killpg(pid, signal.SIGKILL)
 
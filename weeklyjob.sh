@@ -23,8 +23,8 @@ source $poky_dir/oe-init-build-env $build_dir
 $auh_dir/upgradehelper.py -e all
 
 # clean up to avoid the disk filling up
-rm -rf $build_dir/tmp/
-rm -rf $build_dir/workspace/sources/*
+rm -rf $build_dir/tmp/ $build_dir/tmp-auh-*/ $build_dir/upgrade-helper/workers/*/tmp/ $build_dir/upgrade-helper/prefetch/tmp/
+rm -rf $build_dir/workspace/sources/* $build_dir/upgrade-helper/workers/*/workspace/sources/*
 find $sstate_dir -atime +10 -delete
 
 popd